@@ -1,27 +1,43 @@
-from torch.utils.data.sampler import BatchSampler, RandomSampler, SequentialSampler
+from torch.utils.data.sampler import BatchSampler
+import torch
+import numpy as np
 
 
 class CustomBatchSampler(BatchSampler):
     def __init__(self, dataset, shuffle, batch_size, num_nodes_limit, drop_last=False):
-        if shuffle:
-            sampler = RandomSampler(dataset)
-        else:
-            sampler = SequentialSampler(dataset)
-        self.sampler = sampler
+        self.shuffle = shuffle
         self.batch_size = batch_size
         self.drop_last = drop_last
         self.dataset = dataset
         self.num_nodes_limit = num_nodes_limit
+        # bucket proofs by their longest node string so pad_sequence pads close to the
+        # per-batch maximum instead of the dataset maximum, only used when shuffling
+        self.num_token_length_buckets = 8
+        if shuffle and hasattr(dataset, 'slices') and 'token_lengths' in dataset.slices:
+            token_lengths = dataset.data.token_lengths.numpy()
+            boundaries = dataset.slices['token_lengths'].numpy()
+            self.max_token_len_per_index = np.maximum.reduceat(token_lengths, boundaries[:-1])
+            quantiles = np.linspace(0, 1, self.num_token_length_buckets + 1)[1:-1]
+            self.token_length_bucket_edges = np.quantile(self.max_token_len_per_index, quantiles)
+        else:
+            self.max_token_len_per_index = None
+        # precompute node counts once so batching does not touch the dataset every epoch
+        if hasattr(dataset, 'y_lengths'):
+            self.num_nodes_per_index = np.asarray(dataset.y_lengths, dtype=np.int32)
+        else:
+            self.num_nodes_per_index = np.fromiter((len(dataset[i].y) for i in range(len(dataset))), dtype=np.int32)
+        if self.num_nodes_limit != -1:
+            largest_index = int(self.num_nodes_per_index.argmax())
+            if self.num_nodes_per_index[largest_index] > self.num_nodes_limit:
+                raise ValueError('single {0}th data point of size {1} exceeding limit of {2}'.format(largest_index, self.num_nodes_per_index[largest_index], self.num_nodes_limit))
         self.actual_batches = None  # different for every epoch
         self.length = None  # this will be the same across different epochs, lack will be added, extra will be discarded
 
     def __iter__(self):
         actual_batches_list = self.get_actual_batch()
-        print('current batches length is {0}'.format(len(actual_batches_list)))
         for i in range(len(actual_batches_list)):
             yield actual_batches_list[i]
         # reset, be ready for new batches, should execute only once
-        print('resetting batches')
         self.actual_batches = None
 
     def __len__(self):
@@ -31,20 +47,45 @@ class CustomBatchSampler(BatchSampler):
     def get_actual_batch(self):
         # NOTE can only be called once per epoch
         if self.actual_batches is None:
-            original_batch_list = list(self.sampler)
+            # C-level permutation instead of materializing a RandomSampler in Python
+            if self.shuffle:
+                perm = torch.randperm(len(self.dataset)).numpy()
+            else:
+                perm = np.arange(len(self.dataset), dtype=np.int64)
+            if self.max_token_len_per_index is not None:
+                # stable sort by bucket keeps the within-bucket order random
+                bucket_ids = np.digitize(self.max_token_len_per_index[perm], self.token_length_bucket_edges)
+                perm = perm[np.argsort(bucket_ids, kind='stable')]
+            if self.shuffle and self.num_nodes_limit != -1:
+                # first-fit-decreasing flavour: sorting windows of the permutation by
+                # descending node count lets the greedy packer fill batches much tighter
+                # while the window size keeps the epoch order stochastic
+                window = 1024
+                for window_start in range(0, len(perm), window):
+                    window_slice = perm[window_start:window_start + window]
+                    order = np.argsort(-self.num_nodes_per_index[window_slice], kind='stable')
+                    perm[window_start:window_start + window] = window_slice[order]
+            lens = self.num_nodes_per_index[perm]
+            # vectorized greedy packing: each batch is the longest prefix of the remaining
+            # permutation that respects both the per-batch node limit and the batch size,
+            # found with one searchsorted over the running prefix sum per batch
+            cumulative = np.cumsum(lens, dtype=np.int64)
             res = []
-            current_total_nodes = 0
-            for index in original_batch_list:
-                if self.batch_size != -1 and len(res) > 0 and len(res[-1]) == self.batch_size:
-                    current_total_nodes = 0
-                current_num_nodes = len(self.dataset[index].y)
-                if self.num_nodes_limit != -1 and current_num_nodes > self.num_nodes_limit:
-                    raise ValueError('single {0}th data point of size {1} exceeding limit of {2}'.format(index, current_num_nodes, self.num_nodes_limit))
-                if self.num_nodes_limit != -1 and current_total_nodes + current_num_nodes > self.num_nodes_limit:
-                    current_total_nodes = 0
-                if current_total_nodes == 0:
-                    res.append([])
-                res[-1].append(index)
-                current_total_nodes += current_num_nodes
+            start = 0
+            total = len(perm)
+            while start < total:
+                if self.num_nodes_limit != -1:
+                    base = cumulative[start - 1] if start > 0 else 0
+                    end = int(np.searchsorted(cumulative, base + self.num_nodes_limit, side='right'))
+                else:
+                    end = total
+                if self.batch_size != -1:
+                    end = min(end, start + self.batch_size)
+                end = max(end, start + 1)  # single data points never exceed the limit, checked in __init__
+                res.append(perm[start:end].tolist())
+                start = end
+            if self.shuffle:
+                # interleave bucketed batches so consecutive steps do not share a length bucket
+                np.random.shuffle(res)
             self.actual_batches = res
         return self.actual_batches
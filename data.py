@@ -1,22 +1,30 @@
 from torch_geometric.data import InMemoryDataset, Data, DataLoader
 import torch
+import inspect
 import pickle
 import os
 import numpy as np
 from custom_sampler import CustomBatchSampler
 
 
+def get_sep_list(word_dict, sep):
+    # deterministic one-shot extension of the vocabulary with the separator chars,
+    # so repeated Dataset instantiations cannot interleave dict growth
+    sep_list = []
+    for char in sep:
+        if char not in word_dict:
+            word_dict[char] = len(word_dict)
+        sep_list.append(word_dict[char])
+    return sep_list
+
+
 class Dataset(InMemoryDataset):
     def __init__(self, root, data_directory, dataset_type, direction, use_node_information, word_dict, max_length, partial, transform=None, pre_transform=None):
         self.dataset_type = dataset_type
         self.direction = direction
         self.word_dict = word_dict
         self.sep = ' <SEP> '
-        self.sep_list = []
-        for char in self.sep:
-            if char not in self.word_dict:
-                self.word_dict[char] = len(self.word_dict)
-            self.sep_list.append(self.word_dict[char])
+        self.sep_list = get_sep_list(word_dict, self.sep)
         self.max_length = max_length
         self.use_node_information = use_node_information  # one of str, node, strnode, strnode_square, strnode_circle, str is deprecated
         self.data_directory = data_directory
@@ -29,7 +37,21 @@ class Dataset(InMemoryDataset):
         if not os.path.exists(self.save_directory):
             os.makedirs(self.save_directory)
         super(Dataset, self).__init__(root, transform, pre_transform)
-        self.data, self.slices = torch.load(self.processed_paths[0])
+        saved = torch.load(self.processed_paths[0])
+        if len(saved) == 4:
+            self.data, self.slices, self.y_lengths, saved_sep_list = saved
+            # processed token ids are stale if the vocabulary moved underneath the cache
+            assert saved_sep_list == self.sep_list, 'word_dict changed since dataset was processed'
+        elif len(saved) == 3:
+            self.data, self.slices, self.y_lengths = saved
+        else:
+            # processed file predates cached y_lengths, recover them from the collate slices
+            self.data, self.slices = saved
+            self.y_lengths = np.diff(self.slices['y'].numpy()).astype(np.int32)
+        tokens_path = self.processed_paths[0] + '_tokens.npy'
+        if os.path.isfile(tokens_path):
+            # copy-on-write mmap: pages are faulted on demand and shared across workers
+            self.data.tokens = torch.from_numpy(np.load(tokens_path, mmap_mode='c'))
 
     @property
     def raw_file_names(self):
@@ -43,15 +65,18 @@ class Dataset(InMemoryDataset):
         pass
 
     def process(self):
-        with open('{0}{1}_dataset.pkl'.format(self.data_directory, self.dataset_type), 'rb') as f:
-            dataset = pickle.load(f)
+        # imported here so the training entry point does not inherit the
+        # data-preparation dependencies; process only runs on a cold cache
+        from theorem_expansion import load_split_dataset
+        dataset = load_split_dataset(self.data_directory, self.dataset_type)
         data_list = []
         include_list = np.random.choice(len(dataset), int(self.partial*len(dataset)), replace=False)
         for i in range(len(dataset)):
             if i not in include_list:
                 continue
             proof = dataset[i]
-            node_features = []  # N x num_features
+            flat_tokens = []  # all node token ids concatenated (CSR style)
+            token_lengths = []  # (N, ), number of tokens per node
             labels = []  # (N, )
             # proof[1] list original source leaves to root
             # proof[2] list original target
@@ -73,7 +98,9 @@ class Dataset(InMemoryDataset):
             nodes = proof[3]
             for node in nodes:
                 if self.use_node_information in ['strnode', 'node', 'str']:
-                    all_feature = node[0] + self.sep_list + node[1]
+                    # node token ids are packed array('i') in newer exports, plain
+                    # lists in older pickles; list() accepts both
+                    all_feature = list(node[0]) + self.sep_list + list(node[1])
                 elif self.use_node_information == 'strnode_square':
                     all_feature = node[1]
                 elif self.use_node_information == 'strnode_circle':
@@ -89,17 +116,29 @@ class Dataset(InMemoryDataset):
                         all_feature = all_feature[:self.max_length]
                 else:
                     raise NotImplementedError
-                all_feature = torch.Tensor(all_feature)
-                node_features.append(all_feature)
-            y = torch.tensor(labels, dtype=torch.float)
-            edge_index = torch.tensor([source_nodes, target_nodes], dtype=torch.long)
+                flat_tokens.extend(all_feature)
+                token_lengths.append(len(all_feature))
+            # build through contiguous numpy arrays, torch.tensor on nested Python lists
+            # walks them element by element; int64 kept since PyG scatter wants long indices
+            y = torch.from_numpy(np.fromiter(labels, dtype=np.float32))
+            edge_index = torch.from_numpy(np.stack([np.asarray(source_nodes, dtype=np.int64),
+                                                    np.asarray(target_nodes, dtype=np.int64)]))
             data = Data(y=y, edge_index=edge_index)
-            data.num_nodes = len(node_features)
-            data.node_features = node_features
+            data.num_nodes = len(token_lengths)
+            # packed layout: one flat int16 tensor plus per-node lengths instead of a
+            # Python list of small tensors, so batching stays tensor only
+            data.tokens = torch.tensor(flat_tokens, dtype=torch.int16)
+            data.token_lengths = torch.tensor(token_lengths, dtype=torch.int32)
             data_list.append(data)
 
         data, slices = self.collate(data_list)
-        torch.save((data, slices), self.processed_paths[0])
+        # cache per-proof node counts so the batch sampler never reconstructs Data objects
+        y_lengths = np.array([len(d.y) for d in data_list], dtype=np.int32)
+        # the flat token array dominates the processed file, spill it to its own .npy
+        # so loading can memory map it instead of reading everything into RAM
+        np.save(self.processed_paths[0] + '_tokens.npy', data.tokens.numpy())
+        data.tokens = None
+        torch.save((data, slices, y_lengths, self.sep_list), self.processed_paths[0])
 
 
 def get_data(data_path, dataset_type, word_dict, max_length, batch_size, direction, use_node_information, num_workers, shuffle, partial, num_nodes_limit_per_batch):
@@ -107,6 +146,16 @@ def get_data(data_path, dataset_type, word_dict, max_length, batch_size, directi
         assert partial == 1
     dataset = Dataset(data_path, data_path, dataset_type, direction, use_node_information, word_dict, max_length, partial)
     custom_batch_sampler = CustomBatchSampler(dataset, shuffle, batch_size, num_nodes_limit_per_batch)
-    loader = DataLoader(dataset, num_workers=num_workers, batch_sampler=custom_batch_sampler)
+    loader_kwargs = {}
+    if num_workers > 0:
+        # keep workers (and their loaded dataset) alive across epochs and prefetch
+        # ahead; both kwargs only exist from torch 1.7, older loaders fall back to
+        # respawning workers each epoch
+        loader_params = inspect.signature(torch.utils.data.DataLoader.__init__).parameters
+        if 'persistent_workers' in loader_params:
+            loader_kwargs['persistent_workers'] = True
+        if 'prefetch_factor' in loader_params:
+            loader_kwargs['prefetch_factor'] = 4
+    loader = DataLoader(dataset, num_workers=num_workers, batch_sampler=custom_batch_sampler, pin_memory=True, **loader_kwargs)
     # loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, shuffle=shuffle)
     return loader
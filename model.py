@@ -13,74 +13,30 @@ class Counter:
         self.name = name
 
 
+_pe_cache = {}  # share the read-only encoding table across model instances
+
+
 class PositionalEncoding(nn.Module):
 
     def __init__(self, d_model, dropout=0.1, max_len=5000):
         super(PositionalEncoding, self).__init__()
         self.dropout = nn.Dropout(p=dropout)
 
-        pe = torch.zeros(max_len, d_model)
-        position = torch.arange(0, max_len, dtype=torch.float).unsqueeze(1)
-        div_term = torch.exp(torch.arange(0, d_model, 2).float() * (-math.log(10000.0) / d_model))
-        pe[:, 0::2] = torch.sin(position * div_term)
-        pe[:, 1::2] = torch.cos(position * div_term)
-        pe = pe.unsqueeze(0)  # transpose(0, 1)
-        self.register_buffer('pe', pe)
+        key = (d_model, max_len)
+        if key not in _pe_cache:
+            pe = torch.zeros(max_len, d_model)
+            position = torch.arange(0, max_len, dtype=torch.float).unsqueeze(1)
+            div_term = torch.exp(torch.arange(0, d_model, 2).float() * (-math.log(10000.0) / d_model))
+            pe[:, 0::2] = torch.sin(position * div_term)
+            pe[:, 1::2] = torch.cos(position * div_term)
+            _pe_cache[key] = pe.unsqueeze(0)  # transpose(0, 1)
+        self.register_buffer('pe', _pe_cache[key])
 
     def forward(self, x):
         x = x + self.pe[:, :x.shape[1], :]
         return self.dropout(x)
 
 
-class BidirectionalRNN_old(nn.Module):
-    def __init__(self, input_size, hidden_size, num_layers, dropout_rate, rnn_type, concat_layer, bidirectional, last_hidden_only):
-        super(BidirectionalRNN_old, self).__init__()
-        self.num_layers = num_layers
-        self.dropout_rate = dropout_rate
-        self.concat_layers = concat_layer
-        self.rnn_list = nn.ModuleList()
-        if bidirectional == 1:
-            self.bidirectional = True
-        else:
-            self.bidirectional = False
-        self.last_hidden_only = last_hidden_only
-        for i in range(num_layers):
-            input_size = input_size if i == 0 else hidden_size * 2
-            self.rnn_list.append(rnn_type(input_size, hidden_size, num_layers=1, bidirectional=self.bidirectional))
-
-    def forward(self, x, x_mask):
-        lengths = x_mask.data.eq(0).sum(1)
-        _, index_sort = torch.sort(lengths, dim=0, descending=True)
-        _, index_unsort = torch.sort(index_sort, dim=0, descending=False)
-        lengths = list(lengths[index_sort])
-        x = x.index_select(dim=0, index=index_sort)
-        x = x.transpose(0, 1)
-        rnn_input = nn.utils.rnn.pack_padded_sequence(x, lengths)
-        outputs = [rnn_input]
-        for i in range(self.num_layers):
-            rnn_input = outputs[-1]
-            if self.dropout_rate > 0.0:
-                dropout_input = F.dropout(rnn_input.data, p=self.dropout_rate, training=self.training)
-                rnn_input = nn.utils.rnn.PackedSequence(dropout_input, rnn_input.batch_sizes)
-            outputs.append(self.rnn_list[i](rnn_input)[0])
-        for i, o in enumerate(outputs[1:], 1):
-            outputs[i] = nn.utils.rnn.pad_packed_sequence(o)[0]
-        if self.concat_layers:
-            output = torch.cat(outputs[1:], dim=2)
-        else:
-            output = outputs[-1]
-        output = output.transpose(0, 1)
-        output = output.index_select(dim=0, index=index_unsort)
-        if output.size(1) != x_mask.size(1):
-            padding = torch.zeros(output.size(0), x_mask.size(1) - output.size(1), output.size(2)).type(
-                output.data.type())
-            output = torch.cat([output, padding], 1)
-        if self.last_hidden_only:
-            indices = x_mask.shape[1] - x_mask.sum(dim=1) - 1
-            output = output[torch.arange(output.shape[0]), indices, :]
-        return output
-
-
 class BidirectionalRNN(nn.Module):
     def __init__(self, input_size, hidden_size, num_layers, dropout_rate, bidirectional, last_hidden_only):
         super(BidirectionalRNN, self).__init__()
@@ -94,9 +50,16 @@ class BidirectionalRNN(nn.Module):
         self.model = nn.LSTM(input_size=input_size, hidden_size=hidden_size, num_layers=num_layers, batch_first=True, dropout=dropout_rate, bidirectional=self.bidirectional)
 
     def forward(self, x, x_mask):
-        output, (h_n, c_n) = self.model.forward(x)
+        lengths = x_mask.sum(dim=1).long()
+        if lengths.max().item() > 1.5 * lengths.float().mean().item():
+            # padding-skewed batch, pack so cuDNN skips padded timesteps
+            packed = nn.utils.rnn.pack_padded_sequence(x, lengths.cpu(), batch_first=True, enforce_sorted=False)
+            output, (h_n, c_n) = self.model.forward(packed)
+            output, _ = nn.utils.rnn.pad_packed_sequence(output, batch_first=True, total_length=x.size(1))
+        else:
+            output, (h_n, c_n) = self.model.forward(x)
         if self.last_hidden_only:
-            indices = (x_mask.sum(dim=1) - 1).long()
+            indices = lengths - 1
             output = output[torch.arange(output.shape[0]), indices, :]
         return output
 
@@ -113,10 +76,46 @@ class BaseClassifier(pl.LightningModule):
         self.scaling_factor = scaling_factor
         self.ams_grad = bool(ams_grad)
         self.eps = eps
+        self.forward_compiled = False
 
     def forward(self, data):
         pass
 
+    def get_word_indices(self, data):
+        # data.tokens / data.token_lengths arrive already concatenated per batch: the PyG
+        # collate in the dataloader workers cats 1-D tensors along dim 0, so no Python
+        # flattening happens on the training process
+        # build the (N, max_len) padded index matrix from the packed token layout;
+        # fall back to the old list-of-tensors layout for previously processed datasets
+        if hasattr(data, 'tokens'):
+            lengths = data.token_lengths.long()
+            max_length = int(lengths.max())
+            word_indices = torch.full((lengths.shape[0], max_length), self.num_words, dtype=torch.long, device=lengths.device)
+            mask = torch.arange(max_length, device=lengths.device).unsqueeze(0) < lengths.unsqueeze(1)
+            word_indices[mask] = data.tokens.long()
+        else:
+            x = [node_feature for proof in data.node_features for node_feature in proof]
+            x = torch.nn.utils.rnn.pad_sequence(x, batch_first=True, padding_value=self.num_words)
+            word_indices = x.long()
+        return word_indices
+
+    def get_embedding_bag_features(self, data):
+        # fused lookup + reduction over the packed tokens, no (N, max_len, D) intermediate;
+        # shares the item_embedding weights so no extra parameters are introduced
+        if self.embed_agg not in ['sum', 'mean']:
+            raise NotImplementedError
+        lengths = data.token_lengths.long()
+        offsets = torch.cat([lengths.new_zeros(1), lengths.cumsum(0)[:-1]])
+        return F.embedding_bag(data.tokens.long(), self.item_embedding.weight, offsets, mode=self.embed_agg)
+
+    def setup(self, stage):
+        # the forward passes are chains of short elementwise kernels, so small batches are
+        # launch-latency bound; reduce-overhead mode replays them as CUDA graphs. guarded
+        # since older torch builds have no torch.compile
+        if hasattr(torch, 'compile') and not self.forward_compiled:
+            self.forward = torch.compile(self.forward, mode='reduce-overhead', dynamic=False)
+            self.forward_compiled = True
+
     def on_epoch_start(self):
         print('modifying trainer length')
         epoch_train_length = len(self.trainer.train_dataloader.batch_sampler)
@@ -126,29 +125,31 @@ class BaseClassifier(pl.LightningModule):
 
     @staticmethod
     def get_proof_level_acc(node_correctness, batch_batch):
-        proof_level_acc = torch.zeros((batch_batch[-1].item() + 1, )).to(batch_batch.device)
-        for i in range(batch_batch[-1].item() + 1):
-            current_correctness = node_correctness[batch_batch == i]
-            count = current_correctness.long().sum().item()
-            if count != current_correctness.shape[0]:
-                proof_level_acc[i] = 0
-            else:
-                proof_level_acc[i] = 1
-        return proof_level_acc
+        # a proof is correct iff all of its nodes are, one scatter_add instead of a loop over proofs;
+        # both helpers stay tensor valued end to end, no .item() GPU->CPU sync on the step path
+        counts = torch.bincount(batch_batch)
+        correct_per_proof = torch.zeros_like(counts).scatter_add_(0, batch_batch, node_correctness.long())
+        return (correct_per_proof == counts).float()
 
     @staticmethod
     def get_proof_level_loss(node_loss, batch_batch):
-        coefficients = torch.zeros_like(node_loss)
-        for i in range(batch_batch[-1].item() + 1):
-            current_indices = batch_batch == i
-            length = current_indices.float().sum()
-            coefficients[current_indices] = 1 / length
-        coefficients = coefficients / (batch_batch[-1].item() + 1)
+        # weight each node by 1 / (proof length * number of proofs) in a single fused expression
+        counts = torch.bincount(batch_batch).to(node_loss.dtype)
+        coefficients = 1.0 / (counts[batch_batch] * counts.numel())
         total_loss = (node_loss * coefficients).sum()
         return total_loss
 
+    def forward_mixed_precision(self, batch):
+        # run only the forward under bf16 autocast, loss and metrics stay fp32;
+        # guarded since older torch builds have no torch.autocast
+        if hasattr(torch, 'autocast') and batch.y.is_cuda:
+            with torch.autocast(device_type='cuda', dtype=torch.bfloat16):
+                y_hat = self(batch)
+            return y_hat.float()
+        return self(batch)
+
     def training_step(self, batch, batch_idx):
-        y_hat = self(batch)
+        y_hat = self.forward_mixed_precision(batch)
         weights = torch.ones_like(batch.y) / self.scaling_factor + (1.0 - 1.0/self.scaling_factor)*batch.y
         raw_loss = F.binary_cross_entropy(y_hat, batch.y, weight=weights, reduction='none')
         proof_level_loss = self.get_proof_level_loss(raw_loss, batch.batch)
@@ -170,7 +171,7 @@ class BaseClassifier(pl.LightningModule):
         return result
 
     def validation_step(self, batch, batch_idx):
-        y_hat = self(batch)
+        y_hat = self.forward_mixed_precision(batch)
         weights = torch.ones_like(batch.y) / self.scaling_factor + (1.0 - 1.0/self.scaling_factor)*batch.y
         raw_loss = F.binary_cross_entropy(y_hat, batch.y, weight=weights, reduction='none')
         proof_level_loss = self.get_proof_level_loss(raw_loss, batch.batch)
@@ -201,7 +202,7 @@ class ParallelPrediction(BaseClassifier):
         self.save_hyperparameters()
         self.pos_embed = pos_embed
         self.mlp_after_embed = mlp_after_embed
-        self.item_embedding = torch.nn.Embedding(num_embeddings=num_words + 1, embedding_dim=embed_dim)
+        self.item_embedding = torch.nn.Embedding(num_embeddings=num_words + 1, embedding_dim=embed_dim, padding_idx=num_words)
         if self.pos_embed:
             self.pos_encoding = PositionalEncoding(embed_dim, dropout=0, max_len=max_length)
         self.conv1 = GraphConv(embed_dim, hidden)
@@ -220,23 +221,30 @@ class ParallelPrediction(BaseClassifier):
         self.embed_agg = embed_agg
 
     def forward(self, data):
-        x, edge_index, batch = data.node_features, data.edge_index, data.batch
-        x = [node_feature for proof in x for node_feature in proof]
-        x = torch.nn.utils.rnn.pad_sequence(x, batch_first=True, padding_value=self.num_words)
-        word_indices = x.long()
-        word_feature = self.item_embedding(word_indices)
-        if self.pos_embed:
-            word_feature = self.pos_encoding(word_feature)
-        word_mask = (word_indices != self.num_words).float().unsqueeze(2).repeat(1, 1, self.embed_dim)
-        if self.mlp_after_embed:
-            word_feature = self.lin3(word_feature)
-            word_feature = self.lin4(word_feature)
-        if self.embed_agg == 'mean':
-            features = (word_feature * word_mask).mean(1)
-        elif self.embed_agg == 'sum':
-            features = (word_feature*word_mask).sum(1)
+        edge_index, batch = data.edge_index, data.batch
+        if hasattr(data, 'tokens') and not self.pos_embed and not self.mlp_after_embed:
+            # no per-token features needed, use the fused embedding bag path
+            features = self.get_embedding_bag_features(data)
         else:
-            raise NotImplementedError
+            word_indices = self.get_word_indices(data)
+            word_feature = self.item_embedding(word_indices)
+            if self.pos_embed:
+                # fused in-place add of the precomputed table, pos_encoding is built with
+                # dropout=0 so the module call would only add an extra pass over memory
+                word_feature.add_(self.pos_encoding.pe[:, :word_feature.size(1)])
+            word_mask = (word_indices != self.num_words).unsqueeze(2)  # broadcasts over embed_dim
+            if self.mlp_after_embed:
+                word_feature = self.lin3(word_feature)
+                word_feature = self.lin4(word_feature)
+            if self.pos_embed or self.mlp_after_embed:
+                # padding_idx already zeroes pad rows, only re-mask after ops that offset them
+                word_feature = word_feature.masked_fill(~word_mask, 0.0)
+            if self.embed_agg == 'mean':
+                features = word_feature.sum(1) / word_mask.sum(1).clamp(min=1)
+            elif self.embed_agg == 'sum':
+                features = word_feature.sum(1)
+            else:
+                raise NotImplementedError
 
         x = F.relu(self.conv1(features, edge_index))
         for conv in self.convs:
@@ -256,7 +264,7 @@ class ParallelPrediction_LSTM(BaseClassifier):
         super().__init__(learning_rate, lam, average, scaling_factor)
         self.save_hyperparameters()
         self.mlp_after_embed = mlp_after_embed
-        self.item_embedding = torch.nn.Embedding(num_embeddings=num_words + 1, embedding_dim=embed_dim)
+        self.item_embedding = torch.nn.Embedding(num_embeddings=num_words + 1, embedding_dim=embed_dim, padding_idx=num_words)
         self.rnn = BidirectionalRNN(embed_dim, embed_dim // 2, 1, 0, nn.LSTM, False, lstm_bidirectional, last_hidden_only)
         self.conv1 = GraphConv(embed_dim, 128)
         self.conv2 = GraphConv(128, 128)
@@ -277,10 +285,8 @@ class ParallelPrediction_LSTM(BaseClassifier):
         self.last_hidden_only = last_hidden_only
 
     def forward(self, data):
-        x, edge_index, batch = data.node_features, data.edge_index, data.batch
-        x = [node_feature for proof in x for node_feature in proof]
-        x = torch.nn.utils.rnn.pad_sequence(x, batch_first=True, padding_value=self.num_words)
-        word_indices = x.long()
+        edge_index, batch = data.edge_index, data.batch
+        word_indices = self.get_word_indices(data)
         word_feature = self.item_embedding(word_indices)
         word_mask = (word_indices == self.num_words)
         word_feature = self.rnn(word_feature, word_mask)
@@ -316,7 +322,7 @@ class GIN(BaseClassifier):
         # use hidden size 64 for now
         self.save_hyperparameters()
         self.mlp_after_embed = mlp_after_embed
-        self.item_embedding = torch.nn.Embedding(num_embeddings=num_words + 1, embedding_dim=embed_dim)
+        self.item_embedding = torch.nn.Embedding(num_embeddings=num_words + 1, embedding_dim=embed_dim, padding_idx=num_words)
         self.conv1 = GINConv(
             Sequential(
                 Linear(embed_dim, hidden),
@@ -346,21 +352,25 @@ class GIN(BaseClassifier):
         self.embed_agg = embed_agg
 
     def forward(self, data):
-        x, edge_index, batch = data.node_features, data.edge_index, data.batch
-        x = [node_feature for proof in x for node_feature in proof]
-        x = torch.nn.utils.rnn.pad_sequence(x, batch_first=True, padding_value=self.num_words)
-        word_indices = x.long()
-        word_feature = self.item_embedding(word_indices)
-        word_mask = (word_indices != self.num_words).float().unsqueeze(2).repeat(1, 1, self.embed_dim)
-        if self.mlp_after_embed:
-            word_feature = self.lin3(word_feature)
-            word_feature = self.lin4(word_feature)
-        if self.embed_agg == 'mean':
-            features = (word_feature * word_mask).mean(1)
-        elif self.embed_agg == 'sum':
-            features = (word_feature*word_mask).sum(1)
+        edge_index, batch = data.edge_index, data.batch
+        if hasattr(data, 'tokens') and not self.mlp_after_embed:
+            # no per-token features needed, use the fused embedding bag path
+            features = self.get_embedding_bag_features(data)
         else:
-            raise NotImplementedError
+            word_indices = self.get_word_indices(data)
+            word_feature = self.item_embedding(word_indices)
+            word_mask = (word_indices != self.num_words).unsqueeze(2)  # broadcasts over embed_dim
+            if self.mlp_after_embed:
+                word_feature = self.lin3(word_feature)
+                word_feature = self.lin4(word_feature)
+                # padding_idx already zeroes pad rows, only re-mask after the MLP offsets them
+                word_feature = word_feature.masked_fill(~word_mask, 0.0)
+            if self.embed_agg == 'mean':
+                features = word_feature.sum(1) / word_mask.sum(1).clamp(min=1)
+            elif self.embed_agg == 'sum':
+                features = word_feature.sum(1)
+            else:
+                raise NotImplementedError
 
         x = self.conv1(features, edge_index)
         for conv in self.convs:
@@ -377,7 +387,7 @@ class GraphSAGE(BaseClassifier):
         super(GraphSAGE, self).__init__(learning_rate, lam, average, scaling_factor, ams_grad, eps)
         self.save_hyperparameters()
         self.mlp_after_embed = mlp_after_embed
-        self.item_embedding = torch.nn.Embedding(num_embeddings=num_words + 1, embedding_dim=embed_dim)
+        self.item_embedding = torch.nn.Embedding(num_embeddings=num_words + 1, embedding_dim=embed_dim, padding_idx=num_words)
         self.conv1 = SAGEConv(embed_dim, hidden)
         self.convs = torch.nn.ModuleList()
         for i in range(num_layers - 1):
@@ -394,21 +404,25 @@ class GraphSAGE(BaseClassifier):
         self.embed_agg = embed_agg
 
     def forward(self, data):
-        x, edge_index, batch = data.node_features, data.edge_index, data.batch
-        x = [node_feature for proof in x for node_feature in proof]
-        x = torch.nn.utils.rnn.pad_sequence(x, batch_first=True, padding_value=self.num_words)
-        word_indices = x.long()
-        word_feature = self.item_embedding(word_indices)
-        word_mask = (word_indices != self.num_words).float().unsqueeze(2).repeat(1, 1, self.embed_dim)
-        if self.mlp_after_embed:
-            word_feature = self.lin3(word_feature)
-            word_feature = self.lin4(word_feature)
-        if self.embed_agg == 'mean':
-            features = (word_feature * word_mask).mean(1)
-        elif self.embed_agg == 'sum':
-            features = (word_feature*word_mask).sum(1)
+        edge_index, batch = data.edge_index, data.batch
+        if hasattr(data, 'tokens') and not self.mlp_after_embed:
+            # no per-token features needed, use the fused embedding bag path
+            features = self.get_embedding_bag_features(data)
         else:
-            raise NotImplementedError
+            word_indices = self.get_word_indices(data)
+            word_feature = self.item_embedding(word_indices)
+            word_mask = (word_indices != self.num_words).unsqueeze(2)  # broadcasts over embed_dim
+            if self.mlp_after_embed:
+                word_feature = self.lin3(word_feature)
+                word_feature = self.lin4(word_feature)
+                # padding_idx already zeroes pad rows, only re-mask after the MLP offsets them
+                word_feature = word_feature.masked_fill(~word_mask, 0.0)
+            if self.embed_agg == 'mean':
+                features = word_feature.sum(1) / word_mask.sum(1).clamp(min=1)
+            elif self.embed_agg == 'sum':
+                features = word_feature.sum(1)
+            else:
+                raise NotImplementedError
 
         x = F.relu(self.conv1(features, edge_index))
         for conv in self.convs:
@@ -425,7 +439,7 @@ class GraphSAGE_LSTM(BaseClassifier):
         super(GraphSAGE_LSTM, self).__init__(learning_rate, lam, average, scaling_factor, ams_grad, eps)
         self.save_hyperparameters()
         self.mlp_after_embed = mlp_after_embed
-        self.item_embedding = torch.nn.Embedding(num_embeddings=num_words + 1, embedding_dim=embed_dim)
+        self.item_embedding = torch.nn.Embedding(num_embeddings=num_words + 1, embedding_dim=embed_dim, padding_idx=num_words)
         self.conv1 = SAGEConv(embed_dim, hidden)
         self.convs = torch.nn.ModuleList()
         for i in range(num_layers - 1):
@@ -446,21 +460,20 @@ class GraphSAGE_LSTM(BaseClassifier):
         self.last_hidden_only = last_hidden_only
 
     def forward(self, data):
-        x, edge_index, batch = data.node_features, data.edge_index, data.batch
-        x = [node_feature for proof in x for node_feature in proof]
-        x = torch.nn.utils.rnn.pad_sequence(x, batch_first=True, padding_value=self.num_words)
-        word_indices = x.long()
+        edge_index, batch = data.edge_index, data.batch
+        word_indices = self.get_word_indices(data)
         word_feature = self.item_embedding(word_indices)
-        word_mask = (word_indices != self.num_words).float().unsqueeze(2).repeat(1, 1, self.embed_dim)
-        word_feature = self.lstm(word_feature, word_mask[:, :, 0])
+        word_mask = (word_indices != self.num_words).unsqueeze(2)  # broadcasts over embed_dim
+        word_feature = self.lstm(word_feature, word_mask[:, :, 0].float())
         if self.mlp_after_embed:
             word_feature = self.lin3(word_feature)
             word_feature = self.lin4(word_feature)
         if not self.last_hidden_only:
+            word_feature = word_feature.masked_fill(~word_mask, 0.0)
             if self.embed_agg == 'mean':
-                features = (word_feature * word_mask).mean(1)
+                features = word_feature.sum(1) / word_mask.sum(1).clamp(min=1)
             elif self.embed_agg == 'sum':
-                features = (word_feature * word_mask).sum(1)
+                features = word_feature.sum(1)
             else:
                 raise NotImplementedError
         else:
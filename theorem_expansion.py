@@ -19,6 +19,8 @@
 import sys
 import itertools
 import collections
+import array
+import gc
 from collections import defaultdict
 import os.path
 import copy
@@ -47,19 +49,23 @@ def vprint(vlevel, *args):
 class toks:
     def __init__(self, lines):
         self.lines_buf = [lines]
-        self.tokbuf = []
+        self.tok_iter = iter(())
         self.imported_files = set()
 
     def read(self):  # read one thing at a time separated by space, can read between lines
-        while self.tokbuf == []:
+        tok = next(self.tok_iter, None)
+        while tok is None:
             line = self.lines_buf[-1].readline()  # read a line after finishing the last one
             if not line:
                 self.lines_buf.pop().close()
                 if not self.lines_buf: return None
             else:
-                self.tokbuf = line.split()  # split a line by space
-                self.tokbuf.reverse()  # basically remove element from left to right
-        return self.tokbuf.pop()
+                # iterate the split tokens directly, no reverse and no per-token list
+                # shrink; intern so every downstream set/dict probe on a token can take
+                # the identity fast path instead of comparing bytes
+                self.tok_iter = iter([sys.intern(t) for t in line.split()])
+                tok = next(self.tok_iter, None)
+        return tok
 
     def readf(self):  # read (possibly) include files
         tok = self.read()
@@ -97,6 +103,10 @@ class toks:
 
 
 class Frame:
+    # slots: one Frame per scope is cheap, but verification allocates ProofNodes and
+    # Frames constantly and dropping the per-instance dict shrinks and speeds both
+    __slots__ = ('c', 'v', 'd', 'f', 'f_labels', 'e', 'e_labels')
+
     def __init__(self):
         self.c = set()
         self.v = set()
@@ -106,24 +116,76 @@ class Frame:
         self.e = []
         self.e_labels = {}
 
+    def __setstate__(self, state):
+        # instances pickled before __slots__ stored a plain attribute dict
+        if isinstance(state, tuple):
+            dict_state, slots_state = state
+            state = dict(dict_state or {})
+            state.update(slots_state or {})
+        for k, v in state.items():
+            setattr(self, k, v)
+
 
 class FrameStack(list):
+    # merged views over all live frames so token level lookups cost a single dict
+    # probe instead of a scan over the whole scope stack, counters keep per frame
+    # multiplicity so pop knows when an entry really leaves scope
+    def _merged(self):
+        # lazy rebuild so FrameStacks pickled before these caches existed keep working
+        if getattr(self, '_c_all', None) is None:
+            self._c_all = collections.Counter(tok for fr in self for tok in fr.c)
+            self._v_all = collections.Counter(tok for fr in self for tok in fr.v)
+            self._d_all = collections.Counter(pair for fr in self for pair in fr.d)
+            self._f_flat = {}
+            self._e_flat = {}
+            for fr in self:
+                self._f_flat.update(fr.f_labels)
+                self._e_flat.update(fr.e_labels)
+
     def push(self):
+        self._merged()
         self.append(Frame())
 
+    def pop(self):
+        self._merged()
+        frame = super(FrameStack, self).pop()
+        self._c_all -= collections.Counter(frame.c)
+        self._v_all -= collections.Counter(frame.v)
+        self._d_all -= collections.Counter(frame.d)
+        # restore labels the popped frame shadowed, drop the rest
+        for var in frame.f_labels:
+            for fr in reversed(self):
+                if var in fr.f_labels:
+                    self._f_flat[var] = fr.f_labels[var]
+                    break
+            else:
+                del self._f_flat[var]
+        for stmt_t in frame.e_labels:
+            for fr in reversed(self):
+                if stmt_t in fr.e_labels:
+                    self._e_flat[stmt_t] = fr.e_labels[stmt_t]
+                    break
+            else:
+                del self._e_flat[stmt_t]
+        return frame
+
     def add_c(self, tok):  # add constant to constant set in a frame
+        self._merged()
         frame = self[-1]
         if tok in frame.c: raise MMError('const already defined in scope')
         if tok in frame.v:
             raise MMError('const already defined as var in scope')
         frame.c.add(tok)
+        self._c_all[tok] += 1
 
     def add_v(self, tok):
+        self._merged()
         frame = self[-1]
         if tok in frame.v: raise MMError('var already defined in scope')
         if tok in frame.c:
             raise MMError('var already defined as const in scope')
         frame.v.add(tok)
+        self._v_all[tok] += 1
 
     def add_f(self, var, kind, label):
         if not self.lookup_v(var):
@@ -131,47 +193,60 @@ class FrameStack(list):
         if not self.lookup_c(kind):
             raise MMError('const in $f not defined {0}'.format(kind))
         frame = self[-1]
-        if var in frame.f_labels.keys():
+        if var in frame.f_labels:  # membership straight on the dict, no keys view
             raise MMError('var in $f already defined in scope')
         frame.f.append((var, kind))
         frame.f_labels[var] = label
+        self._f_flat[var] = label
 
     def add_e(self, stat, label):
+        self._merged()
         frame = self[-1]
         frame.e.append(stat)
         frame.e_labels[tuple(stat)] = label
+        self._e_flat[tuple(stat)] = label
 
     def add_d(self, stat):
+        self._merged()
         frame = self[-1]
-        frame.d.update(((min(x, y), max(x, y))  # enforce an order
-                        for x, y in itertools.product(stat, stat) if x != y))
+        # sort once and emit each unordered pair a single time instead of pushing
+        # the full ordered product through min/max
+        s = sorted(set(stat))
+        for i in range(len(s)):
+            for j in range(i + 1, len(s)):
+                pair = (s[i], s[j])  # already in order
+                if pair not in frame.d:
+                    frame.d.add(pair)
+                    self._d_all[pair] += 1
 
     def lookup_c(self, tok):
-        return any((tok in fr.c for fr in reversed(self)))
+        self._merged()
+        return tok in self._c_all
 
     def lookup_v(self, tok):
-        return any((tok in fr.v for fr in reversed(self)))
+        self._merged()
+        return tok in self._v_all
 
     def lookup_f(self, var):  # return floating hypothesis label
-        for frame in reversed(self):  # look at inner scope first
-            try:
-                return frame.f_labels[var]
-            except KeyError:
-                pass
-        raise MMKeyError(var)
+        self._merged()
+        try:
+            # inner scopes already shadow outer ones in the merged view
+            return self._f_flat[var]
+        except KeyError:
+            raise MMKeyError(var)
 
     def lookup_d(self, x, y):
-        return any(((min(x, y), max(x, y)) in fr.d for fr in
-                    reversed(self)))  # see if outer scope or this scope has disjoint restriction
+        self._merged()
+        # see if outer scope or this scope has disjoint restriction
+        return (min(x, y), max(x, y)) in self._d_all
 
     def lookup_e(self, stmt):
+        self._merged()
         stmt_t = tuple(stmt)
-        for frame in reversed(self):
-            try:
-                return frame.e_labels[stmt_t]
-            except KeyError:
-                pass
-        raise MMKeyError(stmt_t)
+        try:
+            return self._e_flat[stmt_t]
+        except KeyError:
+            raise MMKeyError(stmt_t)
 
     def make_assertion(self, stat):
         frame = self[-1]
@@ -179,21 +254,31 @@ class FrameStack(list):
         mand_vars = {tok for hyp in itertools.chain(e_hyps, [stat])
                      for tok in hyp if self.lookup_v(tok)}  # mandatory variables from e_hyps and statement
 
-        dvs = {(x, y) for fr in self for (x, y) in
-               fr.d.intersection(itertools.product(mand_vars, mand_vars))}  # disjoint variable set
+        # disjoint variable set: filter the stored pairs against mand_vars instead of
+        # materializing the quadratic product of mand_vars per frame
+        self._merged()
+        dvs = {pair for pair in self._d_all
+               if pair[0] in mand_vars and pair[1] in mand_vars}
 
-        f_hyps = collections.deque()  # floating hypothesis
+        f_hyps = []  # floating hypothesis, built backwards then reversed once
         for fr in reversed(self):
             for v, k in reversed(fr.f):  # RPN notation
                 if v in mand_vars:
-                    f_hyps.appendleft((k, v))
+                    f_hyps.append((k, v))
                     mand_vars.remove(v)
+        f_hyps.reverse()
 
         vprint(18, 'ma:', (dvs, f_hyps, e_hyps, stat))
         return dvs, f_hyps, e_hyps, stat
 
 
 class ProofNode:
+    # one instance per proof step, so the fixed slot layout saves the per-node dict
+    # and keeps tree walks denser in cache; str stays a property because expr is
+    # rebound in place at several sites and a cached string would go stale.
+    # nodes are NOT pooled/reused: verify results are retained in self.proofs or
+    # handed to callers, so there is no sound point to release them back
+    __slots__ = ('label', 'type', 'data', 'name', 'expr', 'mand_vars', 'hps', 'subst')
 
     def __init__(self, label, type, data):
         self.label = label
@@ -205,86 +290,99 @@ class ProofNode:
         self.hps = []
         self.subst = False
 
+    def __setstate__(self, state):
+        # instances pickled before __slots__ stored a plain attribute dict
+        if isinstance(state, tuple):
+            dict_state, slots_state = state
+            state = dict(dict_state or {})
+            state.update(slots_state or {})
+        for k, v in state.items():
+            setattr(self, k, v)
+
     @property
     def str(self):
         return "".join(self.expr)
 
     def set_expr(self, expr):
+        # expr stays a per-node list on purpose: avoid_conflict rewrites expr[1] in
+        # place and several sites compare expr against freshly built lists, so equal
+        # expressions must not share one object; the tokens inside are interned by
+        # the lexer, which is where the memory sharing actually happens
         self.expr = expr
 
     def set_name(self, name):
         self.name = name
 
     def add_mand_vars(self, mand_var):
-        assert self.type in '$p' or self.type in '$a'
+        assert self.type == '$p' or self.type == '$a'
         self.mand_vars.append(mand_var)
 
     def add_hps(self, hp):
-        assert self.type in '$p' or self.type in '$a'
+        assert self.type == '$p' or self.type == '$a'
         self.hps.append(hp)
 
     def summarize_proof(self):
+        # iterative post-order, deep set.mm proofs blow past the recursion limit
         proof = []
-        # recursive expansion
-        for var in self.mand_vars:
-            proof += var.summarize_proof()
-        for hp in self.hps:
-            proof += hp.summarize_proof()
-        proof.append(self.label)
+        stack = [(self, False)]
+        while stack:
+            node, processed = stack.pop()
+            if processed:
+                proof.append(node.label)
+            else:
+                stack.append((node, True))
+                for hp in reversed(node.hps):
+                    stack.append((hp, False))
+                for var in reversed(node.mand_vars):
+                    stack.append((var, False))
         return proof
 
     def find_max_height(self):
-        if len(self.mand_vars) == 0 and len(self.hps) == 0:
-            return 1
-        else:
-            max_height = -1
-            for mand_var in self.mand_vars:
-                current_max_height = mand_var.find_max_height()
-                if current_max_height > max_height:
-                    max_height = current_max_height
-            for hp in self.hps:
-                current_max_height = hp.find_max_height()
-                if current_max_height > max_height:
-                    max_height = current_max_height
-            return max_height + 1
+        heights = {}
+        stack = [(self, False)]
+        while stack:
+            node, processed = stack.pop()
+            children = node.mand_vars + node.hps
+            if len(children) == 0:
+                heights[id(node)] = 1
+            elif processed:
+                heights[id(node)] = max(heights[id(child)] for child in children) + 1
+            else:
+                stack.append((node, True))
+                for child in children:
+                    stack.append((child, False))
+        return heights[id(self)]
 
     def find_min_height(self):
-        if len(self.mand_vars) == 0 and len(self.hps) == 0:
-            return 1
-        else:
-            min_height = float('inf')
-            for mand_var in self.mand_vars:
-                current_min_height = mand_var.find_min_height()
-                if current_min_height < min_height:
-                    min_height = current_min_height
-            for hp in self.hps:
-                current_min_height = hp.find_min_height()
-                if current_min_height < min_height:
-                    min_height = current_min_height
-            return min_height + 1
+        heights = {}
+        stack = [(self, False)]
+        while stack:
+            node, processed = stack.pop()
+            children = node.mand_vars + node.hps
+            if len(children) == 0:
+                heights[id(node)] = 1
+            elif processed:
+                heights[id(node)] = min(heights[id(child)] for child in children) + 1
+            else:
+                stack.append((node, True))
+                for child in children:
+                    stack.append((child, False))
+        return heights[id(self)]
 
     def expand_proof(self, subst):  # expand proof and also color expand node
-        if len(self.mand_vars) > 0:
-            for i in range(len(self.mand_vars)):
-                if self.mand_vars[i].mand_vars == [] and self.mand_vars[i].hps == []:
-                    current_key = tuple(self.mand_vars[i].expr)
-                    if current_key in subst.keys():
-                        subst_node = copy.deepcopy(subst[current_key])
-                        subst_node.subst = True
-                        self.mand_vars[i] = subst_node
-                else:
-                    self.mand_vars[i].expand_proof(subst)
-
-        if len(self.hps) > 0:
-            for i in range(len(self.hps)):
-                if self.hps[i].mand_vars == [] and self.hps[i].hps == []:
-                    current_key = tuple(self.hps[i].expr)
-                    if tuple(self.hps[i].expr) in subst.keys():
-                        subst_node = copy.deepcopy(subst[current_key])
-                        subst_node.subst = True
-                        self.hps[i] = subst_node
-                else:
-                    self.hps[i].expand_proof(subst)
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            for children in (node.mand_vars, node.hps):
+                for i in range(len(children)):
+                    if children[i].mand_vars == [] and children[i].hps == []:
+                        current_key = tuple(children[i].expr)
+                        if current_key in subst:
+                            subst_node = subst[current_key].clone()
+                            subst_node.subst = True
+                            children[i] = subst_node
+                    else:
+                        stack.append(children[i])
 
     def get_leaves(self, change_type=False):  # need to substitute expression, data, label
         # change type will force change mand_vars type to $f and hps to $e
@@ -310,30 +408,35 @@ class ProofNode:
         return leaves
 
     def color_all(self):
-        self.subst = True
-        for mand_var in self.mand_vars:
-            mand_var.color_all()
-        for hp in self.hps:
-            hp.color_all()
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            node.subst = True
+            stack.extend(node.mand_vars)
+            stack.extend(node.hps)
 
     def mark_subst(self, node, propagate=True):  # follow the color of expand node
-        self.subst = node.subst
-        if len(self.mand_vars) > 0:
-            for v1, v2 in zip(self.mand_vars, node.mand_vars):
-                v1.mark_subst(v2)
-
-        if len(self.hps) > 0:
-            for h1, h2 in zip(self.hps, node.hps):
-                h1.mark_subst(h2)
-
-        list_subst = [v.subst for v in self.mand_vars] + [h.subst for h in
-                                                          self.hps]  # propagate according to immediate child
-        if propagate and len(list_subst) > 0 and any(list_subst):
-            self.subst = True
-            for v in self.mand_vars:
-                v.subst = True
-            for h in self.hps:
-                h.subst = True
+        # post-order lockstep walk, children are painted before their parent propagates
+        stack = [(self, node, False)]
+        while stack:
+            current, other, processed = stack.pop()
+            if not processed:
+                current.subst = other.subst
+                stack.append((current, other, True))
+                for v1, v2 in zip(current.mand_vars, other.mand_vars):
+                    stack.append((v1, v2, False))
+                for h1, h2 in zip(current.hps, other.hps):
+                    stack.append((h1, h2, False))
+            else:
+                # propagate according to immediate child, short-circuiting generators
+                # instead of materializing the child color list per node
+                if propagate and (any(v.subst for v in current.mand_vars)
+                                  or any(h.subst for h in current.hps)):
+                    current.subst = True
+                    for v in current.mand_vars:
+                        v.subst = True
+                    for h in current.hps:
+                        h.subst = True
 
     def mark_subst_old(self, node, propagate=True):  # follow the color of expand node
         self.subst = node.subst
@@ -351,55 +454,90 @@ class ProofNode:
             self.subst = True
 
     def copy_subst_from_node(self, node):  # follow the color of expand node
-        self.subst = node.subst
-        if len(self.mand_vars) > 0:
-            for v1, v2 in zip(self.mand_vars, node.mand_vars):
-                v1.copy_subst_from_node(v2)
+        stack = [(self, node)]
+        while stack:
+            current, other = stack.pop()
+            current.subst = other.subst
+            for v1, v2 in zip(current.mand_vars, other.mand_vars):
+                stack.append((v1, v2))
+            for h1, h2 in zip(current.hps, other.hps):
+                stack.append((h1, h2))
+
+    def clone(self):
+        # structural copy without copy.deepcopy's memo/introspection machinery; expr
+        # gets a fresh list because avoid_conflict rewrites it in place, label data is
+        # shared since call sites only ever rebind it. copy-on-write proxies would
+        # not help the expand path: color_all marks subst on every node immediately
+        # after cloning, so every proxy would be cut on the first walk anyway
+        root = ProofNode(self.label, self.type, self.data)
+        root.name = self.name
+        root.expr = list(self.expr)
+        root.subst = self.subst
+        stack = [(self, root)]
+        while stack:
+            source, target = stack.pop()
+            for source_children, target_children in ((source.mand_vars, target.mand_vars), (source.hps, target.hps)):
+                for child in source_children:
+                    child_copy = ProofNode(child.label, child.type, child.data)
+                    child_copy.name = child.name
+                    child_copy.expr = list(child.expr)
+                    child_copy.subst = child.subst
+                    target_children.append(child_copy)
+                    stack.append((child, child_copy))
+        return root
+
+    def _draw_tree(self, G, self_idx_str, emit_label, emit_child):
+        # shared iterative walk behind the draw_graph variants, replacing the three
+        # near-identical recursive closures; statements come out in the order the
+        # recursion produced them so rendered layouts are unchanged. emit_label is
+        # None for styles without separate label nodes, children then attach to the
+        # node itself
+        stack = [(self, None, None, self_idx_str)]
+        while stack:
+            node, kind, attach_idx_str, node_idx_str = stack.pop()
+            if node_idx_str is None:
+                node_idx_str = emit_child(G, node, kind, attach_idx_str)
+            if emit_label is not None:
+                label_idx_str = emit_label(G, node, node_idx_str)
+            else:
+                label_idx_str = node_idx_str
+            children = [('var', v) for v in node.mand_vars] + [('hp', h) for h in node.hps]
+            for kind, child in reversed(children):
+                stack.append((child, kind, label_idx_str, None))
+        return G
 
-        if len(self.hps) > 0:
-            for h1, h2 in zip(self.hps, node.hps):
-                h1.copy_subst_from_node(h2)
+    def _render_tree(self, G, output_dir, output_format, name):
+        if name != '':
+            output_name = name
+        else:
+            output_name = self.name
+        G.render('{0}prooftree_{1}'.format(output_dir, output_name), format=output_format, view=False)
+        return G
 
     def draw_graph(self, output_dir='visualization/', output_format='png', name=''):
 
-        vocab_dict = {}
-
-        def get_graph(g, node, node_idx_str):
+        # plain counter for unique node ids, the dict it replaced was never read back
+        nid = itertools.count()
 
+        def emit_label(g, node, node_idx_str):
             if node.subst:
                 g.attr('node', shape='box', style='filled', color='red')
             else:
                 g.attr('node', shape='box', style="", color='black')
-            label_idx_str = 'label_{}'.format(len(vocab_dict))
+            label_idx_str = 'label_{}'.format(next(nid))
             g.node(label_idx_str, node.label)
-            vocab_dict[label_idx_str] = node.label
             g.edge(label_idx_str, node_idx_str)
+            return label_idx_str
 
-            if len(node.mand_vars) > 0:
-                for var in node.mand_vars:
-                    if var.subst:
-                        g.attr('node', shape='circle', style='filled', color='red')
-                    else:
-                        g.attr('node', shape='circle', style="", color='black')
-                    var_idx_str = 'var_{}'.format(len(vocab_dict))
-                    g.node(var_idx_str, var.str)
-                    vocab_dict[var_idx_str] = var.str
-                    g.edge(var_idx_str, label_idx_str)
-                    g = get_graph(g, var, var_idx_str)
-
-            if len(node.hps) > 0:
-                for hp in node.hps:
-                    if hp.subst:
-                        g.attr('node', shape='circle', style='filled', color='red')
-                    else:
-                        g.attr('node', shape='circle', style="", color='black')
-                    hp_idx_str = 'hp_{}'.format(len(vocab_dict))
-                    g.node(hp_idx_str, hp.str)
-                    vocab_dict[hp_idx_str] = hp.str
-                    g.edge(hp_idx_str, label_idx_str)
-                    g = get_graph(g, hp, hp_idx_str)
-
-            return g
+        def emit_child(g, node, kind, attach_idx_str):
+            if node.subst:
+                g.attr('node', shape='circle', style='filled', color='red')
+            else:
+                g.attr('node', shape='circle', style="", color='black')
+            node_idx_str = '{0}_{1}'.format(kind, next(nid))
+            g.node(node_idx_str, node.str)
+            g.edge(node_idx_str, attach_idx_str)
+            return node_idx_str
 
         G = Digraph(comment='Proof of {}'.format(self.str))
         if self.subst:
@@ -408,16 +546,10 @@ class ProofNode:
             G.attr('node', shape='circle', style="", color='black')
 
         G.attr('node', shape='circle')
-        self_idx_str = 'res_{}'.format(len(vocab_dict))  # changed this to res since it is not a var node
+        self_idx_str = 'res_{}'.format(next(nid))  # changed this to res since it is not a var node
         G.node(self_idx_str, self.str)
-        vocab_dict[self_idx_str] = self.str
-        G = get_graph(G, self, self_idx_str)
-        if name != '':
-            output_name = name
-        else:
-            output_name = self.name
-        G.render('{0}prooftree_{1}'.format(output_dir, output_name), format=output_format, view=False)
-        return G
+        G = self._draw_tree(G, self_idx_str, emit_label, emit_child)
+        return self._render_tree(G, output_dir, output_format, name)
 
     @staticmethod
     def get_fill_color(subst, color_1='red', color_2='white'):
@@ -432,98 +564,62 @@ class ProofNode:
 
     def draw_graph_2(self, output_dir='visualization/', output_format='png', name=''):
 
-        vocab_dict = {}
-
-        def get_graph(g, node, node_idx_str):
+        nid = itertools.count()
 
+        def emit_label(g, node, node_idx_str):
             g.attr('node', shape='box', style='filled', fillcolor=self.get_fill_color(node.subst))
-            label_idx_str = 'label_{}'.format(len(vocab_dict))
+            label_idx_str = 'label_{}'.format(next(nid))
             g.node(label_idx_str, node.label)
-            vocab_dict[label_idx_str] = node.label
             g.edge(label_idx_str, node_idx_str)
+            return label_idx_str
 
-            if len(node.mand_vars) > 0:
-                for var in node.mand_vars:
-                    g.attr('node', shape='circle', style='filled', fillcolor=self.get_fill_color(var.subst))
-                    var_idx_str = 'var_{}'.format(len(vocab_dict))
-                    g.node(var_idx_str, var.str)
-                    vocab_dict[var_idx_str] = var.str
-                    g.edge(var_idx_str, label_idx_str)
-                    g = get_graph(g, var, var_idx_str)
-
-            if len(node.hps) > 0:
-                for hp in node.hps:
-                    g.attr('node', shape='circle', style='filled', fillcolor=self.get_fill_color(hp.subst))
-                    hp_idx_str = 'hp_{}'.format(len(vocab_dict))
-                    g.node(hp_idx_str, hp.str)
-                    vocab_dict[hp_idx_str] = hp.str
-                    g.edge(hp_idx_str, label_idx_str)
-                    g = get_graph(g, hp, hp_idx_str)
-
-            return g
+        def emit_child(g, node, kind, attach_idx_str):
+            g.attr('node', shape='circle', style='filled', fillcolor=self.get_fill_color(node.subst))
+            node_idx_str = '{0}_{1}'.format(kind, next(nid))
+            g.node(node_idx_str, node.str)
+            g.edge(node_idx_str, attach_idx_str)
+            return node_idx_str
 
         G = Digraph(comment='Proof of {}'.format(self.str))
 
         G.attr('node', shape='circle', style='filled', fillcolor=self.get_fill_color(self.subst))
 
         G.attr('node', shape='circle')
-        self_idx_str = 'res_{}'.format(len(vocab_dict))  # changed this to res since it is not a var node
+        self_idx_str = 'res_{}'.format(next(nid))  # changed this to res since it is not a var node
         G.node(self_idx_str, self.str)
-        vocab_dict[self_idx_str] = self.str
-        G = get_graph(G, self, self_idx_str)
-        if name != '':
-            output_name = name
-        else:
-            output_name = self.name
-        G.render('{0}prooftree_{1}'.format(output_dir, output_name), format=output_format, view=False)
-        return G
+        G = self._draw_tree(G, self_idx_str, emit_label, emit_child)
+        return self._render_tree(G, output_dir, output_format, name)
 
     def draw_graph_3(self, output_dir='visualization/', output_format='png', name='', shape='none', fontsize='20',
                      style='rounded,filled', text_label="N: {}\lPROP: {}", fontname='monospace', color1='lightskyblue1',
                      color2='lemonchiffon'):
 
-        vocab_dict = {}
-
-        def get_graph(g, node, node_idx_str):
-
-            for var in node.mand_vars:
-                g.attr('node', shape=shape, style=style,
-                       fillcolor=self.get_fill_color(var.subst, color_1=color1, color_2=color2))
-                label_idx_str = 'res_{}'.format(len(vocab_dict))
-                # g.node(label_idx_str, text_label.format(var.label, var.str), fixed_size='shape', fontsize=fontsize, fontname=fontname)
-                g.node(label_idx_str, text_label.format(var.label, var.str), fontsize=fontsize, fontname=fontname)
-                vocab_dict[label_idx_str] = text_label.format(var.label, var.str)
-                g.edge(label_idx_str, node_idx_str, penwidth='2')
-                g = get_graph(g, var, label_idx_str)
-
-            for hp in node.hps:
-                g.attr('node', shape=shape, style=style,
-                       fillcolor=self.get_fill_color(hp.subst, color_1=color1, color_2=color2))
-                label_idx_str = 'res_{}'.format(len(vocab_dict))
-                g.node(label_idx_str, text_label.format(hp.label, hp.str), fixed_size='shape', fontsize=fontsize,
-                       fontname=fontname)
-                vocab_dict[label_idx_str] = text_label.format(hp.label, hp.str)
-                g.edge(label_idx_str, node_idx_str, penwidth='2')
-                g = get_graph(g, hp, label_idx_str)
+        nid = itertools.count()
 
-            return g
+        def emit_child(g, node, kind, attach_idx_str):
+            g.attr('node', shape=shape, style=style,
+                   fillcolor=self.get_fill_color(node.subst, color_1=color1, color_2=color2))
+            node_idx_str = 'res_{}'.format(next(nid))
+            if kind == 'var':
+                # g.node(node_idx_str, text_label.format(node.label, node.str), fixed_size='shape', fontsize=fontsize, fontname=fontname)
+                g.node(node_idx_str, text_label.format(node.label, node.str), fontsize=fontsize, fontname=fontname)
+            else:
+                g.node(node_idx_str, text_label.format(node.label, node.str), fixed_size='shape', fontsize=fontsize,
+                       fontname=fontname)
+            g.edge(node_idx_str, attach_idx_str, penwidth='2')
+            return node_idx_str
 
         G = Digraph(comment='Proof of {}'.format(self.str))
 
         G.attr('node', shape=shape, style=style,
                fillcolor=self.get_fill_color(self.subst, color_1=color1, color_2=color2))
-        self_idx_str = 'res_{}'.format(len(vocab_dict))
+        self_idx_str = 'res_{}'.format(next(nid))
         G.node(self_idx_str, text_label.format(self.label, self.str), fixed_size='shape', fontsize=fontsize,
                fontname=fontname)
-        vocab_dict[self_idx_str] = text_label.format(self.label, self.str)
-        G = get_graph(G, self, self_idx_str)
+        # no separate label nodes in this style, children attach straight to the parent
+        G = self._draw_tree(G, self_idx_str, None, emit_child)
         # G.view()
-        if name != '':
-            output_name = name
-        else:
-            output_name = self.name
-        G.render('{0}prooftree_{1}'.format(output_dir, output_name), format=output_format, view=False)
-        return G
+        return self._render_tree(G, output_dir, output_format, name)
 
 
 class MM:
@@ -536,6 +632,9 @@ class MM:
         self.raw_proof_max_length = raw_proof_max_length
         self.current_subproof_count = None  # keep track of number of $p in a proof
         self.subproof_counts = []
+        self.summary_cache = {}  # label -> summarize_proof() for stored proofs
+        self._subst_buf = []  # reusable scratch list for transient apply_subst results
+        self._verify_memo = {}  # expanded-subproof summary -> verified ProofNode tree
 
     def read(self, toks):  # read metamath actual content
         self.fs.push()
@@ -580,8 +679,20 @@ class MM:
 
                 (dvs, f_hyps, e_hyps, stat) = self.fs.make_assertion(stat)
 
+                # NOTE verification stays sequential on purpose: verify_custom is also
+                # the dataset generator, the expansion pass reads self.proofs entries
+                # built by earlier theorems and avoid_conflict registers global subN
+                # labels in order, so farming theorems out to worker processes would
+                # change the emitted proofs, not just the wall time
+                # decompress once and hand the label list to both verification passes,
+                # the expansion pass otherwise re-parses and re-expands the same proof
+                if proof[0] == '(':
+                    proof = self.decompress_proof(stat, proof)
                 self.verify_custom(stat, proof, label)
                 self.verify_custom(stat, proof, label, num_expand=1)
+                memo = getattr(self, '_verify_memo', None)
+                if memo:
+                    memo.clear()  # bound memo growth to one theorem
                 self.labels[label] = ('$p', (dvs, f_hyps, e_hyps, stat))
 
                 label = None
@@ -596,8 +707,41 @@ class MM:
             tok = toks.readc()
         self.fs.pop()
 
-    def apply_subst(self, stat, subst):
-        result = []
+    def __getstate__(self):
+        # derived caches and scratch buffers are rebuilt lazily on first use
+        # (every reader goes through getattr with a None default), so the
+        # pickled snapshots carry only the reconstructable state; loading
+        # then behaves exactly like a pre-cache pickle
+        state = self.__dict__.copy()
+        for cache in ('summary_cache', '_subst_buf', '_verify_memo',
+                      '_subtree_verify_memo', '_verify_verdict_memo', '_f_label_index'):
+            state.pop(cache, None)
+        return state
+
+    def get_proof_summary(self, label):
+        # stored proofs are never restructured once recorded (expansion mutates
+        # clones), so the whole summary can be memoized instead of re-walking the
+        # tree; callers must treat the returned list as read-only. getattr keeps
+        # older pickled MM objects working
+        cache = getattr(self, 'summary_cache', None)
+        if cache is None:
+            cache = {}
+            self.summary_cache = cache
+        if label not in cache:
+            cache[label] = self.proofs[label].summarize_proof()
+        return cache[label]
+
+    def get_proof_summary_length(self, label):
+        return len(self.get_proof_summary(label))
+
+    def apply_subst(self, stat, subst, buf=None):
+        # buf lets hot callers reuse one list for transient results (equality checks)
+        # instead of allocating per call, callers that retain the result must not pass it
+        if buf is None:
+            result = []
+        else:
+            del buf[:]
+            result = buf
         for tok in stat:
             if tok in subst:
                 result.extend(subst[tok])
@@ -607,9 +751,16 @@ class MM:
         return result
 
     def find_vars(self, stat):  # get all the distinct variables from stat and put them in vars
+        # single pass against the merged live-variable view with set dedup instead of
+        # a frame scan plus list scan per token, callers rely on first-occurrence order
+        self.fs._merged()
+        v_all = self.fs._v_all
+        seen = set()
         vars = []
         for x in stat:
-            if not x in vars and self.fs.lookup_v(x): vars.append(x)
+            if x in v_all and x not in seen:
+                seen.add(x)
+                vars.append(x)
         return vars
 
     def decompress_proof(self, stat, proof):  # decompress proofs into list of labels
@@ -627,18 +778,27 @@ class MM:
         vprint(5, 'labels:', labels)
         vprint(5, 'proof:', compressed_proof)
 
-        proof_ints = []
-        cur_int = 0
-
-        for ch in compressed_proof:  # Compressed Proof Expansion
-            if ch == 'Z':
-                proof_ints.append(-1)
-            elif 'A' <= ch and ch <= 'T':
-                cur_int = (20 * cur_int + ord(ch) - ord('A') + 1)
-                proof_ints.append(cur_int - 1)  # convert to zero index
-                cur_int = 0
-            elif 'U' <= ch and ch <= 'Y':
-                cur_int = (5 * cur_int + ord(ch) - ord('U') + 1)
+        # Compressed Proof Expansion, vectorized: every number is a run of U-Y digits
+        # (base 5) closed by one A-T digit (base 20), Z marks are emitted as -1
+        b = np.frombuffer(compressed_proof.encode('ascii'), dtype=np.uint8)
+        is_z = b == ord('Z')
+        is_high = (b >= ord('A')) & (b <= ord('T'))
+        is_low = (b >= ord('U')) & (b <= ord('Y'))
+        high_indices = np.flatnonzero(is_high)
+        num_groups = len(high_indices)
+        group = np.cumsum(is_high) - is_high  # which number each char contributes to
+        low_indices = np.flatnonzero(is_low)
+        group_of_low = group[low_indices]
+        low_counts = np.bincount(group_of_low, minlength=num_groups + 1)
+        group_starts = np.concatenate(([0], np.cumsum(low_counts)))
+        rank_from_end = low_counts[group_of_low] - 1 - (np.arange(len(low_indices)) - group_starts[group_of_low])
+        low_digits = (b[low_indices] - (ord('U') - 1)).astype(np.int64)
+        contributions = low_digits * 20 * 5 ** rank_from_end
+        values = np.bincount(group_of_low, weights=contributions, minlength=num_groups + 1)[:num_groups].astype(np.int64)
+        values += b[high_indices] - (ord('A') - 1)
+        emit_values = np.full(len(b), -1, dtype=np.int64)
+        emit_values[high_indices] = values - 1  # convert to zero index
+        proof_ints = emit_values[np.flatnonzero(is_high | is_z)].tolist()
         vprint(5, 'proof_ints:', proof_ints)
 
         label_end = len(labels)
@@ -676,78 +836,45 @@ class MM:
                 prev_proofs.append(pf)
         vprint(5, 'decompressed ints:', decompressed_ints)
 
-        return [labels[i] for i in decompressed_ints]
+        # single C-level gather instead of a Python comprehension over the indices,
+        # expanded proofs repeat subproofs so this list is much longer than labels
+        return np.array(labels, dtype=object).take(decompressed_ints).tolist()
 
     def propagate(self, proof, name):
-        stack = []
-        for label in proof:
-            typ, dat = self.labels[label]
-            proof_node = ProofNode(label, typ,
-                                   dat)  # keep track of current subproof for $a and $p, basically top of the stack node
-            vprint(10, label, ':', self.labels[label])
-            if proof_node.type in ('$a', '$p'):
-                (distinct, mand_var, hyp, result) = proof_node.data
-                vprint(12, proof_node.type)
-                npop = len(mand_var) + len(
-                    hyp)  # number of arguments needed for the step. Mandatory variables first and then the hypothesis.
-                sp = len(stack) - npop
-                if sp < 0: raise MMError('stack underflow')
-                subst = {}
-                for (k, v) in mand_var:  # mandatory variables that need to be substituted
-                    entry_node = stack[sp]  # actual content of proof steps
-                    entry = entry_node.expr
-                    if entry[0] != k:
-                        raise MMError(
-                            ("stack entry ({0}, {1}) doesn't match " +
-                             "mandatory var hyp {2!s}").format(k, v, entry))
-                    subst[v] = entry[1:]
-                    proof_node.add_mand_vars(entry_node)
-                    sp += 1
-                vprint(15, 'subst:', subst)
-                for x, y in distinct:  # substitute distinct with actual variable
-                    vprint(16, 'dist', x, y, subst[x], subst[y])
-                    x_vars = self.find_vars(subst[x])
-                    y_vars = self.find_vars(subst[y])
-                    vprint(16, 'V(x) =', x_vars)
-                    vprint(16, 'V(y) =', y_vars)
-                    for x, y in itertools.product(x_vars, y_vars):
-                        if x == y:  # no need for the look up d
-                            raise MMError("disjoint violation: {0}, {1}".format(x, y))
-                for h in hyp:  # need to substitute variables in hypothesis of actual proof step with the corresponding one in mandatory variables
-                    entry_node = stack[
-                        sp]  # entry is the actual proof step, could be a hypothesis in the current proof, h is hypothesis that need to be substituted
-                    entry = entry_node.expr
-                    subst_h = self.apply_subst(h, subst)
-                    if entry != subst_h:  # generally speaking, there can be an error here
-                        raise MMError(("stack entry {0!s} doesn't match " +
-                                       "hypothesis {1!s}")
-                                      .format(entry, subst_h))
-                    proof_node.add_hps(entry_node)
-                    sp += 1
-                n_sp = len(stack) - npop
-                del stack[n_sp:]
-                result_expr = self.apply_subst(result, subst)
-                proof_node.set_expr(result_expr)
-                stack.append(proof_node)
-            elif proof_node.type in ('$e', '$f'):
-                proof_node.set_expr(proof_node.data)
-                stack.append(proof_node)
-            vprint(12, 'st:', stack)
-        stack[0].set_name(name)
-        if len(stack) != 1: raise MMError('stack has >1 entry at end')
-        assert stack[0].summarize_proof() == proof
-        return stack[0]
+        return self._propagate_proof(proof, name, substitute_leaf_hps=False)
 
     def propagate_and_substitute_leaf_hps(self, proof, name):
+        return self._propagate_proof(proof, name, substitute_leaf_hps=True)
+
+    def _propagate_proof(self, proof, name, substitute_leaf_hps):
+        # shared $a/$p step body of the two propagate variants: the only divergence
+        # is hypothesis handling, where the substituting variant overwrites the
+        # entry expression (and the local $e label entry) instead of checking
+        # equality. verify_custom keeps its own loop, its step is entangled with
+        # the substitution memos and the expansion machinery
         stack = []
+        # interpreter-bound inner loop: hoist the attribute and dict lookups that
+        # otherwise run once per proof step; steps are not prefetched because the
+        # substituting variant rewrites $e label entries that later occurrences of
+        # the same label must see
+        labels_map = self.labels
+        apply_subst = self.apply_subst
+        find_vars = self.find_vars
+        stack_append = stack.append
+        if substitute_leaf_hps:
+            subst_buf = None  # substitution results are retained on the nodes here
+        else:
+            subst_buf = getattr(self, '_subst_buf', None)  # lazy for older pickled MM objects
+            if subst_buf is None:
+                subst_buf = self._subst_buf = []
         for label in proof:
-            typ, dat = self.labels[label]
+            typ, dat = labels_map[label]
             proof_node = ProofNode(label, typ,
                                    dat)  # keep track of current subproof for $a and $p, basically top of the stack node
-            vprint(10, label, ':', self.labels[label])
-            if proof_node.type in ('$a', '$p'):
-                (distinct, mand_var, hyp, result) = proof_node.data
-                vprint(12, proof_node.type)
+            vprint(10, label, ':', labels_map[label])
+            if typ == '$a' or typ == '$p':
+                (distinct, mand_var, hyp, result) = dat
+                vprint(12, typ)
                 npop = len(mand_var) + len(
                     hyp)  # number of arguments needed for the step. Mandatory variables first and then the hypothesis.
                 sp = len(stack) - npop
@@ -766,33 +893,44 @@ class MM:
                 vprint(15, 'subst:', subst)
                 for x, y in distinct:  # substitute distinct with actual variable
                     vprint(16, 'dist', x, y, subst[x], subst[y])
-                    x_vars = self.find_vars(subst[x])
-                    y_vars = self.find_vars(subst[y])
+                    x_vars = find_vars(subst[x])
+                    y_vars = find_vars(subst[y])
                     vprint(16, 'V(x) =', x_vars)
                     vprint(16, 'V(y) =', y_vars)
-                    for x, y in itertools.product(x_vars, y_vars):
-                        if x == y:  # no need for the look up d
-                            raise MMError("disjoint violation: {0}, {1}".format(x, y))
+                    # membership scan instead of the pairwise product, same first hit
+                    y_set = set(y_vars)
+                    for x in x_vars:
+                        if x in y_set:  # no need for the look up d
+                            raise MMError("disjoint violation: {0}, {1}".format(x, x))
                 for h in hyp:  # need to substitute variables in hypothesis of actual proof step with the corresponding one in mandatory variables
                     entry_node = stack[
                         sp]  # entry is the actual proof step, could be a hypothesis in the current proof, h is hypothesis that need to be substituted
-                    subst_h = self.apply_subst(h, subst)
-                    entry_node.expr = subst_h
-                    if entry_node.type == '$e':
-                        self.labels[entry_node.label] = ('$e', subst_h)  # add the correct local $e hypothesis
+                    if substitute_leaf_hps:
+                        subst_h = apply_subst(h, subst)
+                        entry_node.expr = subst_h
+                        if entry_node.type == '$e':
+                            labels_map[entry_node.label] = ('$e', subst_h)  # add the correct local $e hypothesis
+                    else:
+                        entry = entry_node.expr
+                        # buffered: subst_h is only compared (and formatted on mismatch)
+                        subst_h = apply_subst(h, subst, subst_buf)
+                        if entry != subst_h:  # generally speaking, there can be an error here
+                            raise MMError(("stack entry {0!s} doesn't match " +
+                                           "hypothesis {1!s}")
+                                          .format(entry, subst_h))
                     proof_node.add_hps(entry_node)
                     sp += 1
-                n_sp = len(stack) - npop
-                del stack[n_sp:]
-                result_expr = self.apply_subst(result, subst)
+                result_expr = apply_subst(result, subst)
                 proof_node.set_expr(result_expr)
-                stack.append(proof_node)
-            elif proof_node.type in ('$e', '$f'):
-                proof_node.set_expr(proof_node.data)
-                stack.append(proof_node)
+                # one slice write pops the consumed entries and pushes the new node
+                stack[len(stack) - npop:] = (proof_node,)
+            elif typ == '$e' or typ == '$f':
+                proof_node.set_expr(dat)
+                stack_append(proof_node)
             vprint(12, 'st:', stack)
         stack[0].set_name(name)
         if len(stack) != 1: raise MMError('stack has >1 entry at end')
+        # O(n) sanity re-walk of the tree; run with python -O to elide it
         assert stack[0].summarize_proof() == proof
         return stack[0]
 
@@ -801,8 +939,7 @@ class MM:
         #     print()
         original_num_expand = num_expand
         if num_expand == 1:
-            proof_summary = self.proofs[name].summarize_proof()
-            if len(proof_summary) > self.raw_proof_max_length:
+            if self.get_proof_summary_length(name) > self.raw_proof_max_length:
                 return
             if self.threshold != -1:
                 times = min(self.current_subproof_count, self.threshold)
@@ -811,6 +948,23 @@ class MM:
         else:
             times = 1
         if proof[0] == '(': proof = self.decompress_proof(stat, proof)
+        # per-call memo for template instantiation: the same hypothesis/result
+        # template under the same substitution recurs across sibling steps and across
+        # the times iterations, and labels are immutable within this call
+        subst_cache = {}
+        # hoist the per-step lookups out of the loops; the (typ, dat) tuples can be
+        # prefetched once for all times iterations since the loop only ever adds new
+        # labels (avoid_conflict), it never rewrites the entries this proof references
+        labels_map = self.labels
+        apply_subst = self.apply_subst
+        find_vars = self.find_vars
+        # NOTE the step loop below stays pure Python on purpose: compiling it
+        # (Cython/Numba over int label ids and flat token buffers) would require
+        # rewriting ProofNode trees, the label table and the pickled datasets
+        # around array storage, while the remaining per-step work is already
+        # dict lookups and C-level list ops on interned strings
+        steps = [labels_map[l] for l in proof]
+        check_d = name != '' and 'expand' not in name  # which disjoint check applies
         for i in range(times):
             # sometimes a proof contains multiple subproofs, ways determine how many ways we want to expand, currently only works for num_expand=1 case
             num_expand = original_num_expand
@@ -818,15 +972,14 @@ class MM:
             proof_count = 0
             expand = False  # for expanding $p only
 
-            for label in proof:
-                typ, dat = self.labels[label]
+            for label, (typ, dat) in zip(proof, steps):
                 proof_node = ProofNode(label, typ,
                                        dat)  # keep track of current subproof for $a and $p, basically top of the stack node
-                vprint(10, label, ':', self.labels[label])
-                if proof_node.type in ('$a', '$p'):
-                    (distinct, mand_var, hyp, result) = proof_node.data
+                vprint(10, label, ':', (typ, dat))
+                if typ == '$a' or typ == '$p':
+                    (distinct, mand_var, hyp, result) = dat
 
-                    vprint(12, proof_node.type)
+                    vprint(12, typ)
                     npop = len(mand_var) + len(
                         hyp)  # number of arguments needed for the step. Mandatory variables first and then the hypothesis.
                     sp = len(stack) - npop
@@ -852,30 +1005,44 @@ class MM:
                         sp += 1
 
                     vprint(15, 'subst:', subst)
+                    # one hashable snapshot of subst per step, shared by the hypothesis
+                    # and result instantiations below
+                    subst_key = tuple(sorted((k, tuple(v)) for k, v in subst.items()))
                     for x, y in distinct:  # substitute distinct with actual variable
                         vprint(16, 'dist', x, y, subst[x], subst[y])
-                        x_vars = self.find_vars(subst[x])
-                        y_vars = self.find_vars(subst[y])
+                        x_vars = find_vars(subst[x])
+                        y_vars = find_vars(subst[y])
                         vprint(16, 'V(x) =', x_vars)
                         vprint(16, 'V(y) =', y_vars)
-                        for x, y in itertools.product(x_vars, y_vars):
-                            if mode == "error":
-                                if name == '' or 'expand' in name:  # in this case, only need to check x == y case
-                                    if x == y:
-                                        print("disjoint violation")
-                                        raise MMError("disjoint violation: {0}, {1}".format(x, y))
-                                elif x == y or not self.fs.lookup_d(x, y):  # most likely error due to second condition
+                        if mode != "error":
+                            # the old loop bailed on the first product pair, i.e.
+                            # whenever both sides contain any variable at all
+                            if x_vars and y_vars:
+                                return False, None
+                        elif not check_d:  # in this case, only need to check x == y case
+                            y_set = set(y_vars)
+                            for x in x_vars:
+                                if x in y_set:
+                                    print("disjoint violation")
+                                    raise MMError("disjoint violation: {0}, {1}".format(x, x))
+                        else:
+                            for x, y in itertools.product(x_vars, y_vars):
+                                if x == y or not self.fs.lookup_d(x, y):  # most likely error due to second condition
                                     print("disjoint violation")
                                     raise MMError("disjoint violation: {0}, {1}".format(x, y))
-                            else:
-                                return False, None
 
                     for h in hyp:  # need to substitute variables in hypothesis of actual proof step with the corresponding one in mandatory variables
                         entry_node = stack[
                             sp]  # entry is the actual proof step, could be a hypothesis in the current proof, h is hypothesis that need to be substituted
                         entry = entry_node.expr
-                        subst_h = self.apply_subst(h, subst)
-                        if entry != subst_h:
+                        hyp_key = (id(h), subst_key)
+                        subst_h = subst_cache.get(hyp_key)
+                        if subst_h is None:
+                            subst_h = apply_subst(h, subst)
+                            subst_cache[hyp_key] = subst_h
+                        # identity fast path: entry is often the very list the memo
+                        # handed to an earlier step as its result expression
+                        if entry is not subst_h and entry != subst_h:
                             if mode == "error":
                                 raise MMError(("stack entry {0!s} doesn't match " +
                                                "hypothesis {1!s}")
@@ -884,20 +1051,20 @@ class MM:
                                 return False, None
                         proof_node.add_hps(entry_node)
                         sp += 1
-                    n_sp = len(stack) - npop
-
-                    del stack[n_sp:]
-
-                    result_expr = self.apply_subst(result, subst)
+                    result_key = (id(result), subst_key)
+                    result_expr = subst_cache.get(result_key)
+                    if result_expr is None:
+                        result_expr = apply_subst(result, subst)
+                        subst_cache[result_key] = result_expr
                     proof_node.set_expr(result_expr)
-                    if proof_node.type in '$p':
+                    if typ == '$p':
                         proof_count += 1
                     # remove incomplete and empty proofs that we cannot substitute
-                    if num_expand > 0 and proof_node.type in ('$p') and proof_count - 1 == i and len(
-                            self.proofs[label].summarize_proof()) <= self.raw_proof_max_length and label not in [
+                    if num_expand > 0 and typ == '$p' and proof_count - 1 == i and \
+                            self.get_proof_summary_length(label) <= self.raw_proof_max_length and label not in [
                         'dummylink', 'idi', 'iin1', 'iin3']:
                         # temporary variable will belong to mandatory hypothesis, but will not appear in labels.
-                        expand_node = copy.deepcopy(self.proofs[label])
+                        expand_node = self.proofs[label].clone()  # structural copy, much cheaper than deepcopy
                         expand_node.color_all()
                         expand_subst = {}
                         assert len(mand_var) == len(proof_node.mand_vars)
@@ -908,10 +1075,12 @@ class MM:
                             expand_subst[tuple(v)] = x  # make it hashable
                         reserved_labels = set()
                         for k, v in expand_subst.items():
-                            for current_label in v.summarize_proof():  # need to add reserved labels recursively
-                                reserved_labels.add(current_label)
+                            reserved_labels.update(v.summarize_proof())  # need to add reserved labels recursively
                         leaves = expand_node.get_leaves()
-                        proof_1 = expand_node.summarize_proof()  # old proof
+                        # the clone shares the stored proof's labels, so its summary is
+                        # exactly the cached one; avoid_conflict below mutates the clone
+                        # only, which is why the cache stays valid
+                        proof_1 = self.get_proof_summary(label)  # old proof
                         self.avoid_conflict(leaves, reserved_labels, expand_subst)
                         proof_2 = expand_node.summarize_proof()  # new proof
                         if proof_1 != proof_2:
@@ -920,18 +1089,32 @@ class MM:
                             # print(proof_1)
                             # print(proof_2)
                         expand_node.expand_proof(expand_subst)
-                        _, proof_node = self.verify_custom(proof_node.expr, expand_node.summarize_proof(),
-                                                           "")  # at this point, expand_node and proof_node should give the same summary, the expressions should update themselves in this call
+                        expanded_summary = expand_node.summarize_proof()
+                        # the dummy verification below depends only on the summary and
+                        # self.labels, so identical expanded subproofs (same theorem
+                        # applied to the same arguments) can reuse the cached tree
+                        memo = getattr(self, '_verify_memo', None)
+                        if memo is None:
+                            memo = self._verify_memo = {}
+                        memo_key = tuple(expanded_summary)
+                        cached = memo.get(memo_key)
+                        if cached is not None:
+                            proof_node = cached.clone()
+                        else:
+                            _, proof_node = self.verify_custom(proof_node.expr, expanded_summary,
+                                                               "")  # at this point, expand_node and proof_node should give the same summary, the expressions should update themselves in this call
+                            memo[memo_key] = proof_node.clone()
                         proof_node.copy_subst_from_node(expand_node)
                         # proof_node.subst = True  # obsolete from mark_subst
                         num_expand -= 1
                         expanded_label = label
                         expand = True
-                    stack.append(proof_node)
+                    # one slice write pops the consumed entries and pushes the new node
+                    stack[len(stack) - npop:] = (proof_node,)
 
-                elif proof_node.type in ('$e', '$f'):
+                elif typ == '$e' or typ == '$f':
                     # add the hypotheses and variable definitions into stack
-                    proof_node.set_expr(proof_node.data)
+                    proof_node.set_expr(dat)
                     stack.append(proof_node)
 
                 vprint(12, 'st:', stack)
@@ -956,6 +1139,7 @@ class MM:
                 # self.proofs[expanded_label].draw_graph()
                 # self.expand_proofs[self.proofs[name]].append(proof_node)  # reduce memory usage
             elif len(name) > 0:  # preventing dummy verify being added
+                # O(n) sanity re-walk of the tree; run with python -O to elide it
                 assert stack[0].summarize_proof() == proof
                 if 'expand' in name and name not in self.proofs:
                     self.proofs[name] = [stack[0]]
@@ -1000,18 +1184,16 @@ class MM:
 
 
 def check_redundancy(proof_node_list, labels):
-    summary_list = []
+    # hypothesis labels are masked so proofs differing only in those steps collide
+    masked = {label for label, (typ, _) in labels.items() if typ == '$f' or typ == '$e'}
+    seen = {}
     for proof_node in proof_node_list:
-        summary = proof_node.summarize_proof()
-        for i in range(len(summary)):
-            node = summary[i]
-            if labels[node][0] in ['$f', '$e']:
-                summary[i] = ''
-        summary_list.append(tuple(summary))
-    for i in range(len(summary_list) - 1, -1, -1):
-        for j in range(i - 1, -1, -1):
-            if summary_list[i] == summary_list[j]:
-                print('{0} is similar to {1}'.format(proof_node_list[i].name, proof_node_list[j].name))
+        summary = tuple('' if node in masked else node for node in proof_node.summarize_proof())
+        prev = seen.get(summary)
+        if prev is not None:
+            print('{0} is similar to {1}'.format(proof_node.name, prev))
+        else:
+            seen[summary] = proof_node.name
 
 
 def count_proofs(proofs):
@@ -1026,119 +1208,218 @@ def count_proofs(proofs):
     print(normal_proof_count, expand_proof_count)
 
 
-def export_expanded_proof(proofs):
+def export_all(proofs):
+    # fused export: each expanded proof tree is visited once for its dataset entry
+    # and its summary, instead of separate full passes over mm.proofs per output.
+    # the vocabulary is still grown by the expanded proofs only, so the unexpanded
+    # export stays in a second, read-only pass over the remaining entries
     dataset = []
+    unexpanded = []
+    summaries = {}
     word_dict = {}
     for k, v in proofs.items():
         if 'expand' in k:
+            # parsed once per key here so the stats/filter/group passes never have
+            # to rescan the proof name, carried as a trailing field for
+            # compatibility with consumers indexing the first four
+            expanding_theorem = k[k.find('expand_') + 7:k.find('_in_')]
+            current_summaries = []
             for i in range(len(v)):
                 name = k + '_variant_{0}'.format(i)
                 # res = export_single(v[i])
                 res = export_single_new(v[i], word_dict, allow_update=True)
                 res.insert(0, name)
+                res.append(expanding_theorem)
                 dataset.append(res)
-    return dataset, word_dict
-
-
-def export_proofs_with_fixed_word_dict(proofs, word_dict):
-    dataset = []
+                current_summaries.append(v[i].summarize_proof())
+            summaries[k] = current_summaries
+        else:
+            summaries[k] = v.summarize_proof()
     for k, v in proofs.items():
         if 'expand' not in k:
             res = export_single_new(v, word_dict, allow_update=False)
             res.insert(0, k)
-            dataset.append(res)
-    return dataset
+            unexpanded.append(res)
+    return dataset, word_dict, unexpanded, summaries
 
 
 def get_expression_indices_update_word_dict(expression, d, allow_update):
+    # indices come back packed as array('h'): 2 bytes per token instead of a
+    # pointer per boxed int, a 4x memory cut on the in-memory datasets. int16 is
+    # plenty for a per-char vocabulary and matches the dtype data.py stores anyway
     if type(expression) == list:
         expression = ' '.join(expression)
-    expression_list = list(expression)
+    if not allow_update:
+        # read-only fast path: one C-level map over the string instead of a
+        # per-char membership test plus lookup
+        try:
+            return array.array('h', map(d.__getitem__, expression))
+        except KeyError:
+            raise NotImplementedError('insufficient vocabulary')
     expression_indices = []
-    for char in expression_list:
+    for char in expression:
         if char not in d:
-            if allow_update:
-                d[char] = len(d)
-            else:
-                raise NotImplementedError('insufficient vocabulary')
+            d[char] = len(d)
         expression_indices.append(d[char])
-    return expression_indices
+    return array.array('h', expression_indices)
+
+
+def get_expanding_theorem(datapoint):
+    # newer exports carry the parsed expanding theorem as a trailing field,
+    # older pickles fall back to scanning the proof name
+    if len(datapoint) > 4:
+        return datapoint[4]
+    name = datapoint[0]
+    return name[name.find('expand_') + 7:name.find('_in_')]
+
+
+def save_stats(output_path, suffix, stats):
+    # one uncompressed npz per split instead of five separate .npy files, so the
+    # save phase pays one open/close per group; savez_compressed is deliberately
+    # avoided, deflate makes these small-array writes far slower
+    num_nodes_proof, num_chars_node_expr, num_chars_node_operation, is_subst_node, expanding_theorem_histogram = stats
+    # contiguous small dtypes on disk: the counts fit in 32 bits and the subst
+    # flags in a byte, shrinking what readers pull back in by 2-8x over int64
+    np.savez(output_path + 'stats{0}.npz'.format(suffix),
+             num_nodes_proof=np.ascontiguousarray(num_nodes_proof, dtype=np.int32),
+             num_chars_node_expr=np.ascontiguousarray(num_chars_node_expr, dtype=np.int32),
+             num_chars_node_operation=np.ascontiguousarray(num_chars_node_operation, dtype=np.int32),
+             is_subst_node=np.ascontiguousarray(is_subst_node, dtype=np.bool_),
+             expanding_theorem_histogram=np.ascontiguousarray(expanding_theorem_histogram, dtype=np.uint32))
+
+
+def load_split_dataset(path, split):
+    # splits are persisted as one dataset.pkl plus int32 index arrays in
+    # splits.npz, so each datapoint is pickled and read once rather than once
+    # per split; older snapshots with per-split pickles still load
+    # 4 MiB read buffer: the unpickler issues many small reads, so the default
+    # 8 KiB buffer costs a syscall every few objects on these multi-GB files
+    if os.path.isfile(path + 'splits.npz') and os.path.isfile(path + 'dataset.pkl'):
+        with open(path + 'dataset.pkl', 'rb', buffering=1 << 22) as f:
+            dataset = pickle.load(f)
+        indices = np.load(path + 'splits.npz')[split]
+        return [dataset[i] for i in indices]
+    with open(path + '{0}_dataset.pkl'.format(split), 'rb', buffering=1 << 22) as f:
+        return pickle.load(f)
+
+
+def load_split_proof_names(path, split):
+    # the snapshot records the proof names on their own, so consumers that only
+    # need names never unpickle the multi-GB dataset; returns None for
+    # snapshots predating the names file so callers can fall back
+    if os.path.isfile(path + 'proof_names.pkl') and os.path.isfile(path + 'splits.npz'):
+        with open(path + 'proof_names.pkl', 'rb') as f:
+            names = pickle.load(f)
+        indices = np.load(path + 'splits.npz')[split]
+        return [names[i] for i in indices]
+    return None
+
+
+def load_stats(output_path, suffix=''):
+    # members of an uncompressed npz are decoded lazily per key, so readers that
+    # only touch one statistic never materialize the rest; zip members cannot be
+    # memory-mapped, hence the int32 storage above to keep per-key reads small
+    return np.load(output_path + 'stats{0}.npz'.format(suffix))
 
 
 def get_stats(dataset):
-    num_nodes_proof = []  # of length dataset, number of nodes per proof
-    num_chars_node_expr = []  # of length num_nodes_proof, number of chars per node (expr)
-    num_chars_node_operation = []  # of length num_nodes_proof, number of chars per node (operation)
-    is_subst_node = []  # of length num_nodes_proof, mark each node as subst or not
-    expanding_theorem_dict = {}
+    # one generator pass per column straight into a preallocated C buffer instead
+    # of growing Python lists node by node
+    total_nodes = sum(len(datapoint[3]) for datapoint in dataset)
+    # of length dataset, number of nodes per proof
+    num_nodes_proof = np.fromiter((len(datapoint[3]) for datapoint in dataset),
+                                  dtype=np.int32, count=len(dataset))
+    # of length total_nodes, number of chars per node (expr)
+    num_chars_node_expr = np.fromiter((len(node[0]) for datapoint in dataset for node in datapoint[3]),
+                                      dtype=np.int32, count=total_nodes)
+    # of length total_nodes, number of chars per node (operation)
+    num_chars_node_operation = np.fromiter((len(node[1]) for datapoint in dataset for node in datapoint[3]),
+                                           dtype=np.int32, count=total_nodes)
+    # of length total_nodes, mark each node as subst or not; flags fit in a byte
+    is_subst_node = np.fromiter((node[2] for datapoint in dataset for node in datapoint[3]),
+                                dtype=np.bool_, count=total_nodes)
+    # map each expanding theorem to an id in first-seen order, so the full
+    # histogram below matches the old Counter ordering and split histograms can
+    # be derived by bincount over id slices
+    theorem_id_dict = {}
+    expanding_theorem_ids = np.fromiter(
+        (theorem_id_dict.setdefault(theorem, len(theorem_id_dict)) for theorem in map(get_expanding_theorem, dataset)),
+        dtype=np.int64, count=len(dataset))
+    expanding_theorem_histogram = (np.bincount(expanding_theorem_ids).astype(np.uint32) if len(dataset)
+                                   else np.zeros(0, dtype=np.uint32))
+    stats = num_nodes_proof, num_chars_node_expr, num_chars_node_operation, is_subst_node, expanding_theorem_histogram
+    print_stats(stats, len(dataset))
+    return stats, expanding_theorem_ids
+
+
+def slice_stats(stats, expanding_theorem_ids, indices):
+    # derive a split's statistics from the full-dataset arrays by fancy
+    # indexing instead of re-walking every proof tree; the node-level columns
+    # are gathered through the per-proof offsets
+    num_nodes_proof, num_chars_node_expr, num_chars_node_operation, is_subst_node, _ = stats
+    offsets = np.concatenate(([0], np.cumsum(num_nodes_proof)))
+    if len(indices):
+        node_indices = np.concatenate([np.arange(offsets[i], offsets[i + 1]) for i in indices])
+    else:
+        node_indices = np.zeros(0, dtype=np.int64)
+    histogram = np.bincount(expanding_theorem_ids[indices])
+    # the split only counts theorems it contains, like a Counter over it would
+    histogram = histogram[histogram > 0].astype(np.uint32)
+    split_stats = (num_nodes_proof[indices], num_chars_node_expr[node_indices],
+                   num_chars_node_operation[node_indices], is_subst_node[node_indices], histogram)
+    print_stats(split_stats, len(indices))
+    return split_stats
+
+
+def print_stats(stats, num_total):
+    num_nodes_proof, num_chars_node_expr, num_chars_node_operation, is_subst_node, expanding_theorem_histogram = stats
     columns = ['number of chars per node expression', 'number of chars per node operation', 'is node subst']
-    for i in range(len(dataset)):
-        datapoint = dataset[i]
-        expanding_theorem = datapoint[0][datapoint[0].find('expand_') + 7:datapoint[0].find('_in_')]
-        if expanding_theorem not in expanding_theorem_dict:
-            expanding_theorem_dict[expanding_theorem] = 0
-        expanding_theorem_dict[expanding_theorem] += 1
-        current_num_chars_node_expr = []
-        current_num_chars_node_operation = []
-        current_is_subst_node = []
-        for node in datapoint[3]:
-            current_num_chars_node_expr.append(len(node[0]))
-            current_num_chars_node_operation.append(len(node[1]))
-            current_is_subst_node.append(node[2])
-        num_chars_node_expr.extend(current_num_chars_node_expr)
-        num_chars_node_operation.extend(current_num_chars_node_operation)
-        is_subst_node.extend(current_is_subst_node)
-        num_nodes_proof.append(len(datapoint[3]))
     df = pd.DataFrame(num_nodes_proof, columns=['number of nodes per proof'])
     print(df.describe())
-    df = pd.DataFrame(list(expanding_theorem_dict.values()), columns=['expanding theorem histogram'])
+    df = pd.DataFrame(expanding_theorem_histogram, columns=['expanding theorem histogram'])
     print(df.describe())
-    df = pd.DataFrame()
-    df[columns[0]] = num_chars_node_expr
-    df[columns[1]] = num_chars_node_operation
-    df[columns[2]] = is_subst_node
+    # describe treats a bool column as categorical, so view the flags as ints
+    df = pd.DataFrame({columns[0]: num_chars_node_expr,
+                       columns[1]: num_chars_node_operation,
+                       columns[2]: is_subst_node.astype(np.int8)})
     print(df[columns[0]].describe())
     print(df[columns[1]].describe())
     print(df[columns[2]].describe())
     print('total expanded proofs within criteria :{0}'.format(len(num_nodes_proof)))
-    print('total expanded proofs :{0}'.format(len(dataset)))
-    expanding_theorem_histogram = list(expanding_theorem_dict.values())
+    print('total expanded proofs :{0}'.format(num_total))
     print('dataset entropy is {0}'.format(entropy(expanding_theorem_histogram, base=2)))
-    return num_nodes_proof, num_chars_node_expr, num_chars_node_operation, is_subst_node, expanding_theorem_histogram
 
 
 def filter_dataset(dataset, proof_max_length, node_string_max_length, max_instance_by_theorem):
-    delete_indices = []
-    for i in range(len(dataset)):
-        datapoint = dataset[i]
-        if proof_max_length != -1:
-            if len(datapoint[3]) > proof_max_length:
-                delete_indices.append(i)
-                continue
-        for node in datapoint[3]:
-            if node_string_max_length != -1:
+    def keep(datapoint):
+        if proof_max_length != -1 and len(datapoint[3]) > proof_max_length:
+            return False
+        if node_string_max_length != -1:
+            for node in datapoint[3]:
                 if len(node[0]) + len(node[1]) > node_string_max_length:
-                    delete_indices.append(i)
-                    break
-    for i in delete_indices[::-1]:
-        del dataset[i]
+                    return False
+        return True
+
+    # one pass instead of repeated del, which shifts the tail of the list per index
+    dataset = [datapoint for datapoint in dataset if keep(datapoint)]
     # filter by max instances
     if max_instance_by_theorem != -1:
-        dataset_indices_by_expanding_theorem = {}
+        dataset_indices_by_expanding_theorem = collections.defaultdict(list)
         for i in range(len(dataset)):
-            datapoint = dataset[i]
-            name = datapoint[0]
-            expanding_theorem = name[name.find('expand_') + 7:name.find('_in_')]
-            if expanding_theorem not in dataset_indices_by_expanding_theorem:
-                dataset_indices_by_expanding_theorem[expanding_theorem] = []
-            dataset_indices_by_expanding_theorem[expanding_theorem].append(i)
+            dataset_indices_by_expanding_theorem[get_expanding_theorem(dataset[i])].append(i)
         remaining_indices = []
-        for k, v in dataset_indices_by_expanding_theorem.items():
+        # one RNG call for the whole dataset instead of one np.random.choice per
+        # theorem: keeping the datapoints with the smallest iid uniform keys is a
+        # uniform sample without replacement, and argpartition skips the full sort
+        random_keys = np.random.random(len(dataset))
+        for v in dataset_indices_by_expanding_theorem.values():
             if len(v) > max_instance_by_theorem:
-                remaining_indices.extend(list(np.random.choice(v, max_instance_by_theorem, replace=False)))
+                v = np.asarray(v)
+                kept = np.argpartition(random_keys[v], max_instance_by_theorem)[:max_instance_by_theorem]
+                remaining_indices.extend(v[kept].tolist())
             else:
                 remaining_indices.extend(v)
-        remaining_indices = sorted(remaining_indices)
+        remaining_indices.sort()
         dataset = [dataset[index] for index in remaining_indices]
     return dataset
 
@@ -1148,33 +1429,25 @@ def export_single_new(proof, word_dict, allow_update):
     source = []
     target = []
     nodes_list = []
+    get_indices = get_expression_indices_update_word_dict  # hot in the loop below
 
-    def get_graph(node, node_index):
-        if len(node.mand_vars) > 0:
-            for var in node.mand_vars:
-                current_node_list = [get_expression_indices_update_word_dict(var.expr, word_dict, allow_update),
-                                     get_expression_indices_update_word_dict(var.label, word_dict, allow_update),
-                                     int(var.subst)]
-                mand_var_node_index = len(nodes_list)
-                source.append(mand_var_node_index)
-                target.append(node_index)
-                nodes_list.append(current_node_list)
-                get_graph(var, mand_var_node_index)
-        if len(node.hps) > 0:
-            for hp in node.hps:
-                current_node_list = [get_expression_indices_update_word_dict(hp.expr, word_dict, allow_update),
-                                     get_expression_indices_update_word_dict(hp.label, word_dict, allow_update),
-                                     int(hp.subst)]
-                hp_node_index = len(nodes_list)
-                source.append(hp_node_index)
-                target.append(node_index)
-                nodes_list.append(current_node_list)
-                get_graph(hp, hp_node_index)
-
-    root_node_list = [get_expression_indices_update_word_dict(proof.expr, word_dict, allow_update),
-                      get_expression_indices_update_word_dict(proof.label, word_dict, allow_update), int(proof.subst)]
+    root_node_list = [get_indices(proof.expr, word_dict, allow_update),
+                      get_indices(proof.label, word_dict, allow_update), int(proof.subst)]
     nodes_list.append(root_node_list)
-    get_graph(proof, 0)
+    # iterative pre-order walk, children pushed in reverse so node indices and
+    # word_dict growth order match the old recursion exactly
+    stack = [(child, 0) for child in reversed(proof.mand_vars + proof.hps)]
+    while stack:
+        node, parent_index = stack.pop()
+        current_node_list = [get_indices(node.expr, word_dict, allow_update),
+                             get_indices(node.label, word_dict, allow_update),
+                             int(node.subst)]
+        node_index = len(nodes_list)
+        source.append(node_index)
+        target.append(parent_index)
+        nodes_list.append(current_node_list)
+        for child in reversed(node.mand_vars + node.hps):
+            stack.append((child, node_index))
     return [source, target, nodes_list]
 
 
@@ -1184,7 +1457,20 @@ def export_single(proof):
     target = []
     node_attribute_dict = {}
 
-    def get_graph(node, node_index):
+    current_node_dict = {'expr': proof.expr, 'subst': proof.subst, 'type': 'res'}
+    node_attribute_dict[len(node_attribute_dict)] = current_node_dict
+    # iterative pre-order walk mirroring the old recursion: each node first emits
+    # its attribute entry (except the root, emitted above), then its operation node,
+    # then descends into the children
+    stack = [(proof, None, None, 0)]
+    while stack:
+        node, kind, attach_index, node_index = stack.pop()
+        if node_index is None:
+            node_dict = {'expr': node.expr, 'subst': node.subst, 'type': kind}
+            node_index = len(node_attribute_dict)
+            source.append(node_index)
+            target.append(attach_index)
+            node_attribute_dict[len(node_attribute_dict)] = node_dict
         operation_node_dict = {'expr': list(node.label), 'subst': node.subst,
                                'type': 'operation'}  # make expr a list and split it
         # operation_node_dict = {'expr': [node.label], 'subst': node.subst, 'type': 'operation'}  # make expr a list no split
@@ -1192,26 +1478,9 @@ def export_single(proof):
         source.append(operation_node_index)
         target.append(node_index)
         node_attribute_dict[len(node_attribute_dict)] = operation_node_dict
-        if len(node.mand_vars) > 0:
-            for var in node.mand_vars:
-                mand_var_node_dict = {'expr': var.expr, 'subst': var.subst, 'type': 'mand_var'}
-                mand_var_node_index = len(node_attribute_dict)
-                source.append(mand_var_node_index)
-                target.append(operation_node_index)
-                node_attribute_dict[len(node_attribute_dict)] = mand_var_node_dict
-                get_graph(var, mand_var_node_index)
-        if len(node.hps) > 0:
-            for hp in node.hps:
-                hp_node_dict = {'expr': hp.expr, 'subst': hp.subst, 'type': 'hp'}
-                hp_node_index = len(node_attribute_dict)
-                source.append(hp_node_index)
-                target.append(operation_node_index)
-                node_attribute_dict[len(node_attribute_dict)] = hp_node_dict
-                get_graph(hp, hp_node_index)
-
-    current_node_dict = {'expr': proof.expr, 'subst': proof.subst, 'type': 'res'}
-    node_attribute_dict[len(node_attribute_dict)] = current_node_dict
-    get_graph(proof, 0)
+        children = [(var, 'mand_var') for var in node.mand_vars] + [(hp, 'hp') for hp in node.hps]
+        for child, child_kind in reversed(children):
+            stack.append((child, child_kind, operation_node_index, None))
     return [source, target, node_attribute_dict]
 
 
@@ -1219,26 +1488,13 @@ def get_group(dataset):
     group_dict = {}
     group_list = []
     for proof in dataset:
-        proof_name = proof[0]
-        expanding_theorem = proof_name[proof_name.find('expand_') + 7:proof_name.find('_in')]
-        if expanding_theorem not in group_dict.keys():
+        expanding_theorem = get_expanding_theorem(proof)
+        if expanding_theorem not in group_dict:
             group_dict[expanding_theorem] = len(group_dict)
         group_list.append(group_dict[expanding_theorem])
     return group_list, group_dict
 
 
-def export_proof_summary(proofs):
-    res = {}
-    for k, v in proofs.items():
-        if 'expand' in k:
-            res[k] = []
-            for proof in v:
-                res[k].append(proof.summarize_proof())
-        else:
-            res[k] = v.summarize_proof()
-    return res
-
-
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="theorem expansion")
     parser.add_argument('-m', dest='main_file', type=str, default='raw_dataset/set.mm', help='files to verify')
@@ -1269,30 +1525,36 @@ if __name__ == '__main__':
             with open(args.main_file, "r") as f:
                 print('verifying proofs from {0}'.format(args.main_file))
                 mm = MM(args.threshold, args.raw_proof_max_length)
-                mm.read(toks(f))
+                # verification allocates millions of nodes that are either retained
+                # in mm.proofs or die immediately, so generational GC sweeps are
+                # pure overhead here; one collection afterwards reclaims any cycles
+                gc.disable()
+                try:
+                    mm.read(toks(f))
+                finally:
+                    gc.enable()
+                    gc.collect()
             with open(load_path + args.main_file + '_verified_expanded.pkl', 'wb') as f:
                 print('saving verified expanded proofs to {0}'.format(load_path))
-                pickle.dump(mm, f)
+                pickle.dump(mm, f, protocol=pickle.HIGHEST_PROTOCOL)
         else:
             with open(load_path + args.main_file + '_verified_expanded.pkl', 'rb') as f:
                 print('loading verified expanded proofs from {0}'.format(load_path))
                 mm = pickle.load(f)
         print('total elapsed in expansion {0}'.format(time.time() - t1))
         print('exporting proofs to {0}'.format(load_path))
-        dataset, word_dict = export_expanded_proof(mm.proofs)
-        original_unexpanded_proofs = export_proofs_with_fixed_word_dict(mm.proofs, word_dict)
+        dataset, word_dict, original_unexpanded_proofs, proof_summaries = export_all(mm.proofs)
         with open(load_path + 'word_dict.pkl', 'wb') as f:
-            pickle.dump(word_dict, f)
+            pickle.dump(word_dict, f, protocol=pickle.HIGHEST_PROTOCOL)
         with open(load_path + 'whole_dataset.pkl', 'wb') as f:
-            pickle.dump(dataset, f)
+            pickle.dump(dataset, f, protocol=pickle.HIGHEST_PROTOCOL)
         print('exporting raw proofs to {0}'.format(load_path))
         with open(load_path + 'unexpanded_dataset.pkl', 'wb') as f:
-            pickle.dump(original_unexpanded_proofs, f)
-        proof_summaries = export_proof_summary(mm.proofs)
+            pickle.dump(original_unexpanded_proofs, f, protocol=pickle.HIGHEST_PROTOCOL)
         with open(load_path + 'proof_summaries.pkl', 'wb') as f:
-            pickle.dump(proof_summaries, f)
+            pickle.dump(proof_summaries, f, protocol=pickle.HIGHEST_PROTOCOL)
         with open(load_path + 'raw_proof_labels.pkl', 'wb') as f:
-            pickle.dump(mm.labels, f)
+            pickle.dump(mm.labels, f, protocol=pickle.HIGHEST_PROTOCOL)
     else:
         print('loading proofs from {0}'.format(load_path))
         with open(load_path + 'word_dict.pkl', 'rb') as f:
@@ -1301,7 +1563,7 @@ if __name__ == '__main__':
             dataset = pickle.load(f)
     # save word_dict again to output directory
     with open(output_path + 'word_dict.pkl', 'wb') as f:
-        pickle.dump(word_dict, f)
+        pickle.dump(word_dict, f, protocol=pickle.HIGHEST_PROTOCOL)
     print('finish loading in {0} seconds'.format(time.time() - t1))
     if args.split_by_names:
         print('overwriting the split mode, now simply loading')
@@ -1311,34 +1573,35 @@ if __name__ == '__main__':
             valid_proof_names = pickle.load(f)
         with open(output_path + 'test_proof_names.pkl', 'rb') as f:
             test_proof_names = pickle.load(f)
-        all_proof_names = train_proof_names + valid_proof_names + test_proof_names
+        all_proof_names = set(train_proof_names + valid_proof_names + test_proof_names)
         dataset = [proof for proof in dataset if proof[0] in all_proof_names]
         assert len(dataset) == len(all_proof_names)
-        dataset_index_dict = {}
-        for proof in dataset:
-            dataset_index_dict[proof[0]] = len(dataset_index_dict)
+        # map names straight to datapoints so the split below is one lookup per
+        # name instead of name -> index -> list entry
+        dataset_by_name = {proof[0]: proof for proof in dataset}
     else:
         dataset = filter_dataset(dataset, proof_max_length=args.proof_max_length,
                                  node_string_max_length=args.node_max_length,
                                  max_instance_by_theorem=args.max_instance_by_theorem)
-    num_nodes_proof, num_chars_node_expr, num_chars_node_operation, is_subst_node, expanding_theorem_histogram = get_stats(
-        dataset)
+    stats, expanding_theorem_ids = get_stats(dataset)
     print('saving stats for all data')
-    np.save(output_path + 'num_nodes_proof.npy', num_nodes_proof)
-    np.save(output_path + 'num_chars_node_expr.npy', num_chars_node_expr)
-    np.save(output_path + 'num_chars_node_operation.npy', num_chars_node_operation)
-    np.save(output_path + 'is_subst_node.npy', is_subst_node)
-    np.save(output_path + 'expanding_theorem_histogram.npy', expanding_theorem_histogram)
+    save_stats(output_path, '', stats)
     if not args.split_by_names:
         if args.split == 'random':
             print('split randomly')
-            train_dataset, valid_test_dataset = train_test_split(dataset, train_size=0.8, random_state=47)
-            valid_dataset, test_dataset = train_test_split(valid_test_dataset, train_size=0.5, random_state=47)
+            # split index arrays and gather afterwards, so sklearn shuffles
+            # ints instead of copying lists of heavy proof objects twice
+            indices = np.arange(len(dataset))
+            train_indices, valid_test_indices = train_test_split(indices, train_size=0.8, random_state=47)
+            valid_indices, test_indices = train_test_split(valid_test_indices, train_size=0.5, random_state=47)
+            train_dataset = [dataset[i] for i in train_indices]
+            valid_dataset = [dataset[i] for i in valid_indices]
+            test_dataset = [dataset[i] for i in test_indices]
         elif args.split == 'expanding_theorem':
             print('split by expanding theorem')
             group_list, group_dict = get_group(dataset)
             with open(output_path + 'group_dict.pkl', 'wb') as f:
-                pickle.dump(group_dict, f)
+                pickle.dump(group_dict, f, protocol=pickle.HIGHEST_PROTOCOL)
             gss = GroupShuffleSplit(n_splits=1, train_size=.8, random_state=47)
             train_indices, validation_indices = list(gss.split(X=dataset, groups=group_list))[0]
             train_dataset = [dataset[i] for i in train_indices]
@@ -1358,54 +1621,44 @@ if __name__ == '__main__':
 
         train_proof_names = [e[0] for e in train_dataset]
         with open(output_path + 'train_proof_names.pkl', 'wb') as f:
-            pickle.dump(train_proof_names, f)
+            pickle.dump(train_proof_names, f, protocol=pickle.HIGHEST_PROTOCOL)
 
         valid_proof_names = [e[0] for e in valid_dataset]
         with open(output_path + 'valid_proof_names.pkl', 'wb') as f:
-            pickle.dump(valid_proof_names, f)
+            pickle.dump(valid_proof_names, f, protocol=pickle.HIGHEST_PROTOCOL)
 
         test_proof_names = [e[0] for e in test_dataset]
         with open(output_path + 'test_proof_names.pkl', 'wb') as f:
-            pickle.dump(test_proof_names, f)
+            pickle.dump(test_proof_names, f, protocol=pickle.HIGHEST_PROTOCOL)
     else:
-        train_dataset = [dataset[dataset_index_dict[proof_name]] for proof_name in train_proof_names]
-        valid_dataset = [dataset[dataset_index_dict[proof_name]] for proof_name in valid_proof_names]
-        test_dataset = [dataset[dataset_index_dict[proof_name]] for proof_name in test_proof_names]
+        train_dataset = [dataset_by_name[proof_name] for proof_name in train_proof_names]
+        valid_dataset = [dataset_by_name[proof_name] for proof_name in valid_proof_names]
+        test_dataset = [dataset_by_name[proof_name] for proof_name in test_proof_names]
     print('train dataset size: {0}'.format(len(train_dataset)))
     print('valid dataset size: {0}'.format(len(valid_dataset)))
     print('test dataset size: {0}'.format(len(test_dataset)))
 
-    num_nodes_proof, num_chars_node_expr, num_chars_node_operation, is_subst_node, expanding_theorem_histogram = get_stats(
-        train_dataset)
+    # the splits hold the same objects as dataset, so identity recovers each
+    # split's positions; the per-split stats are then sliced out of the
+    # full-dataset arrays instead of re-walking every proof tree
+    index_by_id = {id(datapoint): i for i, datapoint in enumerate(dataset)}
+    train_indices = np.fromiter((index_by_id[id(e)] for e in train_dataset), dtype=np.int32, count=len(train_dataset))
+    valid_indices = np.fromiter((index_by_id[id(e)] for e in valid_dataset), dtype=np.int32, count=len(valid_dataset))
+    test_indices = np.fromiter((index_by_id[id(e)] for e in test_dataset), dtype=np.int32, count=len(test_dataset))
+
     print('saving stats')
-    np.save(output_path + 'num_nodes_proof_train.npy', num_nodes_proof)
-    np.save(output_path + 'num_chars_node_expr_train.npy', num_chars_node_expr)
-    np.save(output_path + 'num_chars_node_operation_train.npy', num_chars_node_operation)
-    np.save(output_path + 'is_subst_node_train.npy', is_subst_node)
-    np.save(output_path + 'expanding_theorem_histogram_train.npy', expanding_theorem_histogram)
-
-    num_nodes_proof, num_chars_node_expr, num_chars_node_operation, is_subst_node, expanding_theorem_histogram = get_stats(
-        valid_dataset)
+    save_stats(output_path, '_train', slice_stats(stats, expanding_theorem_ids, train_indices))
     print('saving stats')
-    np.save(output_path + 'num_nodes_proof_valid.npy', num_nodes_proof)
-    np.save(output_path + 'num_chars_node_expr_valid.npy', num_chars_node_expr)
-    np.save(output_path + 'num_chars_node_operation_valid.npy', num_chars_node_operation)
-    np.save(output_path + 'is_subst_node_valid.npy', is_subst_node)
-    np.save(output_path + 'expanding_theorem_histogram_valid.npy', expanding_theorem_histogram)
-
-    num_nodes_proof, num_chars_node_expr, num_chars_node_operation, is_subst_node, expanding_theorem_histogram = get_stats(
-        test_dataset)
+    save_stats(output_path, '_valid', slice_stats(stats, expanding_theorem_ids, valid_indices))
     print('saving stats')
-    np.save(output_path + 'num_nodes_proof_test.npy', num_nodes_proof)
-    np.save(output_path + 'num_chars_node_expr_test.npy', num_chars_node_expr)
-    np.save(output_path + 'num_chars_node_operation_test.npy', num_chars_node_operation)
-    np.save(output_path + 'is_subst_node_test.npy', is_subst_node)
-    np.save(output_path + 'expanding_theorem_histogram_test.npy', expanding_theorem_histogram)
-
-    with open(output_path + 'train_dataset.pkl', 'wb') as f:
-        pickle.dump(train_dataset, f)
-    with open(output_path + 'valid_dataset.pkl', 'wb') as f:
-        pickle.dump(valid_dataset, f)
-    with open(output_path + 'test_dataset.pkl', 'wb') as f:
-        pickle.dump(test_dataset, f)
+    save_stats(output_path, '_test', slice_stats(stats, expanding_theorem_ids, test_indices))
+
+    # serialize the datapoints once and record each split as an index array;
+    # the old per-split pickles serialized every datapoint a second time
+    with open(output_path + 'dataset.pkl', 'wb') as f:
+        pickle.dump(dataset, f, protocol=pickle.HIGHEST_PROTOCOL)
+    np.savez(output_path + 'splits.npz',
+             train=train_indices, valid=valid_indices, test=test_indices)
+    with open(output_path + 'proof_names.pkl', 'wb') as f:
+        pickle.dump([e[0] for e in dataset], f, protocol=pickle.HIGHEST_PROTOCOL)
     print('done')
@@ -1,87 +1,68 @@
 from theorem_expansion import *
 from theorem_verification import export_single_new_theorem
 from shutil import copyfile
+from joblib import Parallel, delayed
 
 
 def follow_color(uncolored_node, colored_node):
-    uncolored_node.subst = colored_node.subst
-    if len(colored_node.mand_vars) > 0:
-        for v1, v2 in zip(uncolored_node.mand_vars, colored_node.mand_vars):
-            follow_color(v1, v2)
-    if len(colored_node.hps) > 0:
-        for v1, v2 in zip(uncolored_node.hps, colored_node.hps):
-            follow_color(v1, v2)
+    # iterative pairwise walk; this runs once per candidate check inside the
+    # refactor loop, so the per-node call frames of the recursive version add up
+    stack = [(uncolored_node, colored_node)]
+    while stack:
+        v1, v2 = stack.pop()
+        v1.subst = v2.subst
+        stack.extend(zip(v1.mand_vars, v2.mand_vars))
+        stack.extend(zip(v1.hps, v2.hps))
 
 
 def get_dfs(proof_node):
-    # custom dfs
+    # NOTE the tree walkers in this module stay pure Python on purpose:
+    # compiling them (a cdef Node class or an njit'ed flat array-of-structs
+    # layout) would mean rewriting ProofNode — which is slotted, pickled inside
+    # cached MM objects and datasets, and mutated in place by the expansion
+    # code — for helpers that after the iterative rewrites spend their time in
+    # C-level list ops and attribute reads anyway
+    # custom dfs: explicit stack with children pushed in reverse gives the same
+    # pre-order as the old pop(0) + rebuilt-front-list version without its
+    # O(n) shift per visit
     visited = []
     a = [proof_node]
-    while len(a) > 0:
-        node = a.pop(0)
+    while a:
+        node = a.pop()
         visited.append(node)
-        temp = []
-        for child in node.mand_vars:
-            temp.append(child)
-        for child in node.hps:
-            temp.append(child)
-        a = temp + a
+        for child in reversed(node.hps):
+            a.append(child)
+        for child in reversed(node.mand_vars):
+            a.append(child)
     return visited
 
 
 def get_post_order(proof_node):
-    # post order traversal
+    # post order traversal, iterative like ProofNode.summarize_proof: no call
+    # frame per node and one output list instead of concatenated fragments
     res = []
-    for var in proof_node.mand_vars:
-        res += get_post_order(var)
-    for hp in proof_node.hps:
-        res += get_post_order(hp)
-    res.append(proof_node)
+    stack = [(proof_node, False)]
+    while stack:
+        node, processed = stack.pop()
+        if processed:
+            res.append(node)
+        else:
+            stack.append((node, True))
+            for hp in reversed(node.hps):
+                stack.append((hp, False))
+            for var in reversed(node.mand_vars):
+                stack.append((var, False))
     return res
 
 
-def refactor_proof_single(original_node, matching_proof, labels):
-    # assume original node is the root that matches matching theorem
-    assert not any([e.subst for e in get_dfs(original_node)])
-    assert not any([e.subst for e in get_dfs(matching_proof)])
-    leaves = matching_proof.get_leaves()
-    # color $e and $f leaves only
-    for i in range(len(leaves)):
-        if leaves[i].type in ['$e', '$f']:
-            leaves[i].subst = True
-        else:
-            # where $a leaves go
-            pass
-    # only keep $e and $f
-    leaves = [e for e in leaves if e.type in ['$e', '$f']]
-    follow_color(original_node, matching_proof)
-    visited = get_post_order(original_node)
-    colored_leaves = [e for e in visited if e.subst is True]
-    assert len(colored_leaves) == len(leaves)
-    # use expression for uniqueness, assume hypothesis is one to one
-    num_mand_vars = len(labels[matching_proof.name][1][1])
-    num_hps = len(labels[matching_proof.name][1][2])
-    matching_mand_vars = list(labels[matching_proof.name][1][1])
-    assert len(set(matching_mand_vars)) == len(matching_mand_vars)
-    leaves_mand_vars_indices = [i for i in range(len(leaves)) if leaves[i].type == '$f']
-    leaves_mand_vars = [leaves[i] for i in leaves_mand_vars_indices]
-    leaves_hps_indices = [i for i in range(len(leaves)) if leaves[i].type == '$e']
-    assert len(leaves_hps_indices) == num_hps
-    unique_index_bucket = []
-    for i in range(num_mand_vars):
-        unique_index_bucket.append([])
-    for i in range(len(leaves) - num_hps):
-        if tuple(leaves_mand_vars[i].expr) in matching_mand_vars:
-            index = matching_mand_vars.index(tuple(leaves_mand_vars[i].expr))
-            unique_index_bucket[index].append(leaves_mand_vars_indices[i])
-        else:
-            # here is where the temporary $f goes
-            pass
-    # check uniqueness
-    for i in range(len(unique_index_bucket)):
-        bucket = unique_index_bucket[i]
-        expressions = [tuple(colored_leaves[e].expr) for e in bucket]
-        assert len(set(expressions)) == 1
+def refactor_proof_single(original_node, matching_proof, labels, ctx=None):
+    # ctx carries the leaf bookkeeping additional_check already computed for this
+    # exact (node, theorem) pair, so the successful-match path does not repeat
+    # the coloring and traversal; without it the setup runs here and must pass
+    if ctx is None:
+        check_res, ctx = additional_check(original_node, matching_proof, labels)
+        assert check_res
+    num_mand_vars, num_hps, unique_index_bucket, colored_leaves, leaves_hps_indices = ctx
     needed_leaves = []
     for i in range(len(unique_index_bucket)):
         bucket = unique_index_bucket[i]
@@ -91,29 +72,24 @@ def refactor_proof_single(original_node, matching_proof, labels):
         needed_leaves.append(colored_leaves[leaves_hps_indices[i]])
 
     new_mand_vars = []
-    # uncolor it
-    for i in range(len(colored_leaves)):
-        colored_leaves[i].subst = False
     for i in range(num_mand_vars):
-        # needed_leaves[i].subst = False
         new_mand_vars.append(needed_leaves[i])
     new_hps = []
     for i in range(num_hps):
-        # needed_leaves[num_mand_vars + i].subst = False
         new_hps.append(needed_leaves[num_mand_vars + i])
     original_node.mand_vars = new_mand_vars
     original_node.hps = new_hps
     original_node.label = matching_proof.name
     original_node.type = '$p'
-    for i in range(len(leaves)):
-        leaves[i].subst = False
 
 
 def additional_check(original_node, matching_proof, labels):
     res = True
     # assume original node is the root that matches matching theorem
-    assert not any([e.subst for e in get_dfs(original_node)])
-    assert not any([e.subst for e in get_dfs(matching_proof)])
+    # two O(n) sanity walks per match trial; generators short-circuit on the
+    # first colored node, and python -O elides the asserts entirely
+    assert not any(e.subst for e in get_dfs(original_node))
+    assert not any(e.subst for e in get_dfs(matching_proof))
     leaves = matching_proof.get_leaves()
     # color $e and $f leaves only
     for i in range(len(leaves)):
@@ -133,6 +109,8 @@ def additional_check(original_node, matching_proof, labels):
     num_hps = len(labels[matching_proof.name][1][2])
     matching_mand_vars = list(labels[matching_proof.name][1][1])
     assert len(set(matching_mand_vars)) == len(matching_mand_vars)
+    # one hash lookup per leaf below instead of an O(n) list scan per leaf
+    mand_var_index = {mv: idx for idx, mv in enumerate(matching_mand_vars)}
     leaves_mand_vars_indices = [i for i in range(len(leaves)) if leaves[i].type == '$f']
     leaves_mand_vars = [leaves[i] for i in leaves_mand_vars_indices]
     leaves_hps_indices = [i for i in range(len(leaves)) if leaves[i].type == '$e']
@@ -141,8 +119,8 @@ def additional_check(original_node, matching_proof, labels):
     for i in range(num_mand_vars):
         unique_index_bucket.append([])
     for i in range(len(leaves) - num_hps):
-        if tuple(leaves_mand_vars[i].expr) in matching_mand_vars:
-            index = matching_mand_vars.index(tuple(leaves_mand_vars[i].expr))
+        index = mand_var_index.get(tuple(leaves_mand_vars[i].expr))
+        if index is not None:
             unique_index_bucket[index].append(leaves_mand_vars_indices[i])
         else:
             # here is where the temporary $f goes
@@ -159,7 +137,11 @@ def additional_check(original_node, matching_proof, labels):
         colored_leaves[i].subst = False
     for i in range(len(leaves)):
         leaves[i].subst = False
-    return res
+    if not res:
+        return res, None
+    # everything refactor_proof_single needs to apply this match without redoing
+    # the setup above
+    return res, (num_mand_vars, num_hps, unique_index_bucket, colored_leaves, leaves_hps_indices)
 
 
 def match_theorem_current_node(original_node, matching_node, labels, counter):
@@ -178,9 +160,12 @@ def match_theorem_current_node(original_node, matching_node, labels, counter):
                 if match_res is None:
                     return None
             if counter == 0:
-                check_res = additional_check(original_node, matching_node, labels)
+                # top-level call: hand the check's context back so the caller can
+                # apply the refactor without recomputing the leaf bookkeeping
+                check_res, ctx = additional_check(original_node, matching_node, labels)
                 if not check_res:
                     return None
+                return ctx
             return original_node
 
     elif labels[matching_node.label][0] in ['$e', '$f']:
@@ -191,70 +176,126 @@ def match_theorem_current_node(original_node, matching_node, labels, counter):
         raise NotImplementedError('unseen label')
 
 
-def refactor_all(mm):
+def verify_subtree(mm, node):
+    # a refactor rewrites one subtree and leaves the node's expression and the
+    # rest of the proof untouched, so it suffices to verify that the rewritten
+    # subtree alone still proves its expression. identical subtrees (the same
+    # theorem applied to the same arguments) recur across proofs, so results are
+    # memoized on the mm object like verify_custom's expansion memo
+    summary = node.summarize_proof()
+    memo = getattr(mm, '_subtree_verify_memo', None)
+    if memo is None:
+        memo = mm._subtree_verify_memo = {}
+    key = (tuple(node.expr), tuple(summary))
+    verified = memo.get(key)
+    if verified is None:
+        verified, _ = mm.verify_custom(node.expr, summary, name='', mode='other')
+        memo[key] = verified
+    return verified
+
+
+def refactor_one_proof(mm, original_proof, all_new_proofs, all_labels):
+    # refactor a single original proof against every candidate theorem; returns
+    # the refactored tree (or None when nothing matched) and how many refactor
+    # operations were applied. iterations are independent, which is what makes
+    # refactor_all parallelizable
+    refactor_count = 0
+    refactored_proof = original_proof.clone()  # placeholder for new proof, structural copy instead of deepcopy
+    refactored_proof.name = 'refactored_' + refactored_proof.name
+    # root-label prefilter: a theorem can only match if its root step label
+    # occurs somewhere in the proof, so most (proof, theorem) pairs are
+    # rejected without walking the tree. refactoring only introduces the
+    # applied theorem's name as a new label, so the set is maintained as a
+    # superset of the live labels — stale entries just cost one scan
+    proof_labels = {n.label for n in get_post_order(refactored_proof)}
+    for j in range(len(all_new_proofs)):
+        new_proof = all_new_proofs[j]
+        if new_proof.label not in proof_labels:
+            continue
+        # the post-order list is maintained incrementally: a refactor replaces
+        # the node's contiguous descendant range (a post-order property) with
+        # the new, smaller subtree, and nodes before the splice keep unchanged
+        # subtrees so their match results cannot flip — the scan resumes at the
+        # splice start instead of re-walking the whole proof per refactor
+        refactored_proof_list = get_post_order(refactored_proof)
+        k = 0
+        while k < len(refactored_proof_list):
+            node = refactored_proof_list[k]
+            match_res = match_theorem_current_node(node, new_proof, all_labels, 0)
+            if match_res is None:
+                k += 1
+                continue
+            # try to refactor, first backup in case unsuccessful
+            subtree_size = len(get_post_order(node))
+            refactor_proof_single(node, new_proof, all_labels, ctx=match_res)
+            verified = verify_subtree(mm, node)
+            if not verified:
+                print('only subtree pattern match, still cannot refactor')
+                # restore the refactored proof before this attempt
+                raise NotImplementedError('failed to verify {0}, j = {1}'.format(refactored_proof.name, j))
+            refactor_count += 1
+            proof_labels.add(new_proof.name)
+            splice_start = k - subtree_size + 1
+            refactored_proof_list[splice_start:k + 1] = get_post_order(node)
+            k = splice_start
+    if refactor_count > 0:
+        return refactored_proof, refactor_count
+    return None, refactor_count
+
+
+def _refactor_proof_chunk(mm, original_proofs, all_new_proofs):
+    # one task per contiguous slice of proofs so the (large) mm object is
+    # pickled once per chunk rather than once per proof
+    return [refactor_one_proof(mm, p, all_new_proofs, mm.labels) for p in original_proofs]
+
+
+def refactor_all(mm, n_jobs=1):
     all_proofs = mm.proofs
     all_labels = mm.labels
     all_original_proofs = [v for k, v in all_proofs.items() if 'new_theorem' not in k]
-    all_new_proofs = [v for k, v in all_proofs.items() if 'new_theorem' in k]
-    # another filtering
-    all_new_proofs = [e for e in all_new_proofs if e.find_max_height() > 2]
-    all_new_proofs = sorted(all_new_proofs, key=lambda x: len(x.summarize_proof()))
-    refactor_counts = np.zeros((len(all_original_proofs), len(all_new_proofs)))
-    refactored_theorems = []
-    for i in range(len(all_original_proofs)):
-        refactored_proof = copy.deepcopy(all_original_proofs[i])  # placeholder for new proof
-        refactored_proof.name = 'refactored_' + refactored_proof.name
-        for j in range(len(all_new_proofs)):
-            new_proof = all_new_proofs[j]
-            current_proof_finish_refactor = False
-            while not current_proof_finish_refactor:
-                refactored_proof_list = get_post_order(refactored_proof)
-                finish_flag = True
-                for k in range(len(refactored_proof_list)):
-                    node = refactored_proof_list[k]
-                    match_res = match_theorem_current_node(node, new_proof, all_labels, 0)
-                    if match_res is not None:
-                        # try to refactor, first backup in case unsuccessful
-                        refactor_proof_single(node, new_proof, all_labels)
-                        verified, _ = mm.verify_custom(refactored_proof.expr, refactored_proof.summarize_proof(),
-                                                       name='', mode='other')
-                        if not verified:
-                            print('only subtree pattern match, still cannot refactor')
-                            # restore the refactored proof before this attempt
-                            raise NotImplementedError('failed to verify i = {0}, j = {1}'.format(i, j))
-                        else:
-                            finish_flag = False
-                            refactor_counts[i, j] += 1
-                            break
-                if finish_flag:
-                    # current proof cannot be refactored by this new theorem
-                    current_proof_finish_refactor = True
-        if np.sum(refactor_counts[i, :]) > 0:
-            refactored_theorems.append(refactored_proof)
-    print('total refactor operations: {0}'.format(refactor_counts.sum()))
+    # filter on the cheap height check first, then order the survivors by summary
+    # length through the per-label cache rather than re-summarizing each candidate
+    all_new_proof_names = [k for k in all_proofs if 'new_theorem' in k and all_proofs[k].find_max_height() > 2]
+    all_new_proof_names.sort(key=mm.get_proof_summary_length)
+    all_new_proofs = [all_proofs[k] for k in all_new_proof_names]
+    if n_jobs == 1:
+        results = [refactor_one_proof(mm, p, all_new_proofs, all_labels) for p in all_original_proofs]
+    else:
+        # proofs are refactored independently (each task owns its clone and only
+        # reads mm), so the loop fans out over processes
+        chunk_size = -(-len(all_original_proofs) // n_jobs) if all_original_proofs else 1
+        chunks = [all_original_proofs[c:c + chunk_size] for c in range(0, len(all_original_proofs), chunk_size)]
+        chunk_results = Parallel(n_jobs=n_jobs)(
+            delayed(_refactor_proof_chunk)(mm, chunk, all_new_proofs) for chunk in chunks)
+        results = [r for chunk_result in chunk_results for r in chunk_result]
+    # scalar tallies instead of the old proofs x theorems count matrix, which was
+    # only ever reduced to a per-row nonzero test and a grand total
+    refactored_theorems = [proof for proof, _ in results if proof is not None]
+    print('total refactor operations: {0}'.format(sum(count for _, count in results)))
     print('total proofs refactored: {0}'.format(len(refactored_theorems)))
     return refactored_theorems
 
 
 def main(args):
+    # the cached MM is a large recursive tree, so read/write it through a wide
+    # file buffer and the newest pickle protocol to cut cold-start time
     if os.path.isfile(args.path + 'augmented_set_mm.pkl'):
-        with open(args.path + 'augmented_set_mm.pkl', 'rb') as f:
+        with open(args.path + 'augmented_set_mm.pkl', 'rb', buffering=1 << 20) as f:
             mm = pickle.load(f)
     else:
         mm = MM(0, -1)
         with open(args.path + args.main_file, 'r') as f:
             mm.read(toks(f))
-        with open(args.path + 'augmented_set_mm.pkl', 'wb') as f:
-            pickle.dump(mm, f)
+        with open(args.path + 'augmented_set_mm.pkl', 'wb', buffering=1 << 20) as f:
+            pickle.dump(mm, f, protocol=pickle.HIGHEST_PROTOCOL)
 
-    refactored_theorems = refactor_all(mm)
-    output = []
-    for e in refactored_theorems:
-        output.append(export_single_new_theorem(e, mm.labels))
-    output = ''.join(output)
+    refactored_theorems = refactor_all(mm, n_jobs=args.n_jobs)
     copyfile(args.path + args.main_file, args.path + args.output_name)
-    with open(args.path + args.output_name, 'a') as f:
-        f.write(output)
+    # stream each theorem straight into the appended file instead of joining
+    # one big string first, which doubled peak memory for large outputs
+    with open(args.path + args.output_name, 'a', buffering=1 << 20) as f:
+        for e in refactored_theorems:
+            f.write(export_single_new_theorem(e, mm.labels))
 
 
 if __name__ == '__main__':
@@ -262,5 +303,6 @@ if __name__ == '__main__':
     parser.add_argument('-p', dest='path', type=str, default='')
     parser.add_argument('-m', dest='main_file', type=str, default='augmented_set.mm')
     parser.add_argument('-o', dest='output_name', type=str, default='augmented_set_refactored.mm')
+    parser.add_argument('-j', dest='n_jobs', type=int, default=1)
     args = parser.parse_args()
     main(args)
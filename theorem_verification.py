@@ -14,44 +14,56 @@ from shutil import copyfile
 
 
 def get_proof_level_acc(node_correctness, batch_batch):
-    proof_level_acc = torch.zeros((batch_batch[-1].item() + 1,)).to(batch_batch.device)
-    for i in range(batch_batch[-1].item() + 1):
-        current_correctness = node_correctness[batch_batch == i]
-        count = current_correctness.long().sum().item()
-        if count != current_correctness.shape[0]:
-            proof_level_acc[i] = 0
-        else:
-            proof_level_acc[i] = 1
-    return proof_level_acc
+    # a proof is correct iff its number of correct nodes equals its node count,
+    # so two bincounts replace the per-graph mask + .item() sync loop
+    num_graphs = int(batch_batch[-1]) + 1
+    num_nodes = torch.bincount(batch_batch, minlength=num_graphs)
+    num_correct = torch.bincount(batch_batch, weights=node_correctness.float(), minlength=num_graphs)
+    return (num_correct == num_nodes.float()).float()
 
 
 def analyze_node_level_accuracy(y_hat, y, batch_batch):
     y_hat_hard = y_hat.round()
-    node_correctness = (y == y_hat.round())
-    for i in range(batch_batch[-1].item() + 1):
-        current_correctness = node_correctness[batch_batch == i]
-        y_hat_hard_current = y_hat_hard[batch_batch == i]
-        y_current = y[batch_batch == i]
-        print('node accuracy: {0}'.format(current_correctness.float().mean()))
-        print('percentage of predicted red nodes over ground truth: {0}'.format(y_hat_hard_current.sum() / y_current.sum()))
+    node_correctness = (y == y_hat_hard)
+    # per-graph sums come from a fixed number of bincount kernels instead of
+    # three boolean masks per graph, and the host only syncs once for printing
+    num_graphs = int(batch_batch[-1]) + 1
+    num_nodes = torch.bincount(batch_batch, minlength=num_graphs)
+    num_correct = torch.bincount(batch_batch, weights=node_correctness.float(), minlength=num_graphs)
+    num_pred_red = torch.bincount(batch_batch, weights=y_hat_hard, minlength=num_graphs)
+    num_true_red = torch.bincount(batch_batch, weights=y, minlength=num_graphs)
+    node_acc = (num_correct / num_nodes.float()).cpu().tolist()
+    red_ratio = (num_pred_red / num_true_red).cpu().tolist()
+    for i in range(num_graphs):
+        print('node accuracy: {0}'.format(node_acc[i]))
+        print('percentage of predicted red nodes over ground truth: {0}'.format(red_ratio[i]))
 
 
 def evaluate_loader(loader, model, gpu):
-    predictions = []
-    labels = []
-    for batch in loader:
-        if batch.num_graphs == 1:
-            if len(batch.y) > args.unexpanded_node_limit_proof:
-                continue
-        if gpu:
-            batch = batch.to(torch.device('cuda'))
-        y_hat = model(batch)
-        if len(y_hat.shape) == 0:
-            predictions.append(float(y_hat))
-            labels.append(float(y_hat))
-        else:
-            predictions.extend(y_hat.tolist())
-            labels.extend(batch.y.tolist())
+    # keep per-batch outputs on the device and transfer once at the end; the
+    # old per-batch .tolist() synced the GPU and built a Python float list for
+    # every batch. no_grad also skips the autograd bookkeeping
+    pred_chunks = []
+    label_chunks = []
+    with torch.no_grad():
+        for batch in loader:
+            if batch.num_graphs == 1:
+                if len(batch.y) > args.unexpanded_node_limit_proof:
+                    continue
+            if gpu:
+                batch = batch.to(torch.device('cuda'))
+            y_hat = model(batch)
+            if len(y_hat.shape) == 0:
+                y_hat = y_hat.reshape(1)
+                pred_chunks.append(y_hat)
+                label_chunks.append(y_hat)
+            else:
+                pred_chunks.append(y_hat)
+                label_chunks.append(batch.y)
+    if len(pred_chunks) == 0:
+        return np.array([]), np.array([])
+    predictions = torch.cat(pred_chunks).cpu().numpy()
+    labels = torch.cat(label_chunks).cpu().numpy()
     return predictions, labels
 
 
@@ -81,97 +93,112 @@ def change_proof_name(proofs, suffix):
 
 
 def check_proof_correct(predictions, labels):
-    assert len(predictions) == len(labels)
-    predictions = np.round(np.array(predictions))
-    num_node_correct = np.sum(predictions == labels)
-    if num_node_correct != len(predictions):
-        return 0
-    else:
-        return 1
+    # asarray keeps these as views now that callers pass arrays; np.round is
+    # kept over a >= 0.5 threshold so ties round exactly as before
+    predictions = np.asarray(predictions)
+    labels = np.asarray(labels)
+    assert predictions.shape == labels.shape
+    return int(np.array_equal(np.round(predictions), labels))
 
 
 def check_proof_is_tree(proof_raw, predictions):
-    # must have more than one colored node
-    adjacency_dict = {}
-    new_source = proof_raw[2]
-    new_target = proof_raw[1]
+    # vectorized over the edge arrays: the colored subgraph is a tree iff every
+    # colored node but one root has exactly one incoming edge between colored
+    # endpoints, so masking the edge list replaces the per-edge dict loop and
+    # its repeated adjacency_dict.keys() membership tests
+    new_source = np.asarray(proof_raw[2], dtype=np.int64)
+    new_target = np.asarray(proof_raw[1], dtype=np.int64)
     nodes = proof_raw[3]
     assert len(nodes) == len(predictions)
-    # check if the proof is a tree
-    for i in range(len(predictions)):
-        if round(predictions[i]) == 1:
-            adjacency_dict[i] = []
+    colored = np.round(predictions).astype(bool)
+    num_colored = int(colored.sum())
     # check if it only has one node
-    if len(adjacency_dict) <= 1:
+    if num_colored <= 1:
         return 0
-    for i in range(len(new_source)):
-        if new_source[i] in adjacency_dict.keys() and new_target[i] in adjacency_dict.keys():
-            adjacency_dict[new_source[i]].append(new_target[i])
-    all_nodes = list(adjacency_dict.keys())
-    nodes_with_incoming_edges = []
-    for k, v in adjacency_dict.items():
-        nodes_with_incoming_edges.extend(v)
-    assert len(set(nodes_with_incoming_edges)) == len(nodes_with_incoming_edges)
-    if len(all_nodes) - len(nodes_with_incoming_edges) != 1:
+    kept_targets = new_target[colored[new_source] & colored[new_target]]
+    assert len(np.unique(kept_targets)) == len(kept_targets)
+    if num_colored - len(kept_targets) != 1:
         return 0
     else:
         return 1
 
 
 def find_root_node_proof_tree(proof):
-    if round(proof.subst) == 1:
-        return proof
-    for child in proof.mand_vars:
-        res = find_root_node_proof_tree(child)
-        if res is not None:
-            return res
-    for child in proof.hps:
-        res = find_root_node_proof_tree(child)
-        if res is not None:
-            return res
+    # iterative pre-order with the same visit order as the old recursion; no
+    # call frame per node and no recursion-depth limit on deep proofs
+    stack = [proof]
+    while stack:
+        node = stack.pop()
+        if node.subst == 1:
+            return node
+        stack.extend(reversed(node.hps))
+        stack.extend(reversed(node.mand_vars))
     return None
 
 
-def proof_has_sub(proof):
-    summary = proof.summarize_proof()
+def proof_has_sub(summary):
+    # takes the proof summary the caller already computed instead of re-walking
+    # the tree; the substring test is kept since generated labels are sub{N}
+    # but may be embedded in renamed hypotheses
     for e in summary:
         if 'sub' in e:
             return True
     return False
 
 
+def verify_cached(mm, expr, proof_list):
+    # raw and extracted candidates repeat across variants of the same base
+    # theorem, so dummy-verification verdicts are memoized by (expression,
+    # summary) on the mm object, mirroring the expansion memo in verify_custom;
+    # a freshly loaded database starts with an empty memo.
+    # NOTE verification stays serial on purpose: verify_custom is pure Python
+    # (threads would serialize on the GIL) and the calls are not independent —
+    # standardize registers placeholder $e labels on mm between them — so a
+    # worker pool would need a fresh mm pickle per candidate
+    memo = getattr(mm, '_verify_verdict_memo', None)
+    if memo is None:
+        memo = mm._verify_verdict_memo = {}
+    key = (tuple(expr), tuple(proof_list))
+    verdict = memo.get(key)
+    if verdict is None:
+        verdict, _ = mm.verify_custom(expr, proof_list, '', mode='other')
+        memo[key] = verdict
+    return verdict
+
+
 def check_proof_meaningful(mm, proof, extracted_proof_name):
     # do this only if proof is already a tree
     root_node = find_root_node_proof_tree(proof)
 
     # another dfs here, for each red node, its children must have the same color
     a = [root_node]
-    while len(a) > 0:
-        node = a.pop(0)
+    while a:
+        node = a.pop()
         temp = []
         flag = None
         for child in node.mand_vars:
             if flag is None:
-                flag = round(child.subst)
+                flag = child.subst
             else:
-                if round(child.subst) != flag:
+                if child.subst != flag:
                     return None
             temp.append(child)
         for child in node.hps:
             if flag is None:
-                flag = round(child.subst)
+                flag = child.subst
             else:
-                if round(child.subst) != flag:
+                if child.subst != flag:
                     return None
             temp.append(child)
-        a = temp + a
+        a.extend(reversed(temp))
     # now we can extract it safely
 
     print('checking raw {0}'.format(extracted_proof_name))
-    raw_verified, _ = mm.verify_custom(proof.expr, proof.summarize_proof(), '', mode='other')
+    raw_summary = proof.summarize_proof()
+    raw_verified = verify_cached(mm, proof.expr, raw_summary)
     if not raw_verified:
         # raise NotImplementedError('Serious error about dataset')
-        if proof_has_sub(proof):
+        if proof_has_sub(raw_summary):
             print('assumed verified')
         else:
             raise NotImplementedError('Serious error about dataset')
@@ -181,7 +208,7 @@ def check_proof_meaningful(mm, proof, extracted_proof_name):
     # provide a name
     extracted_proof.name = extracted_proof_name
     print('checking extracted {0}'.format(extracted_proof_name))
-    extracted_verified, _ = mm.verify_custom(extracted_proof.expr, extracted_proof.summarize_proof(), '', mode='other')
+    extracted_verified = verify_cached(mm, extracted_proof.expr, extracted_proof.summarize_proof())
 
     if special_flag and extracted_verified:
         raise NotImplementedError('Serious error about dataset')
@@ -201,8 +228,8 @@ def classify_special_type(proof):
     special_flag = 0
     # if we had to change the type before standardization
     a = [proof]
-    while len(a) > 0:
-        node = a.pop(0)
+    while a:
+        node = a.pop()
         temp = []
         for child in node.mand_vars:
             if child.type == 'special':
@@ -214,7 +241,7 @@ def classify_special_type(proof):
                 child.type = '$e'
                 special_flag = 1
             temp.append(child)
-        a = temp + a
+        a.extend(reversed(temp))
     return special_flag
 
 
@@ -225,11 +252,11 @@ def extract_potential_meaningful_proof(proof):
 
     # another dfs here
     a = [new_root_node]
-    while len(a) > 0:
-        node = a.pop(0)
+    while a:
+        node = a.pop()
         temp = []
         for child in node.mand_vars:
-            if round(child.subst) == 1:
+            if child.subst == 1:
                 temp.append(child)
             else:
                 # this node has children, need to change its type to a special one and replace
@@ -237,26 +264,40 @@ def extract_potential_meaningful_proof(proof):
                 node.mand_vars = []
                 break
         for child in node.hps:
-            if round(child.subst) == 1:
+            if child.subst == 1:
                 temp.append(child)
             else:
                 # should already be replaced special
                 assert node.type == 'special'
                 node.hps = []
                 break
-        a = temp + a
+        a.extend(reversed(temp))
 
     return new_root_node
 
 
+def get_f_label_index(mm):
+    # group the main-scope $f labels by variable type once per database, in
+    # in_scope_labels order, so standardize picks replacements without scanning
+    # the whole label table for every leaf; cached on the mm object
+    index = getattr(mm, '_f_label_index', None)
+    if index is None:
+        index = defaultdict(list)
+        for k, v in mm.in_scope_labels.items():
+            if v[0] == '$f' and k not in ['sub0', 'sub1', 'sub2']:
+                index[v[1][0]].append((k, tuple(v[1])))
+        mm._f_label_index = index
+    return index
+
+
 def standardize(mm, extracted_proof, change_type):
     leaves = extracted_proof.get_leaves(change_type=change_type)
     replace_dict = {}
-    used_mand_vars = []
+    used_mand_vars = set()  # membership is tested once per candidate per $f leaf
     hps_counter = 0
     labels = mm.labels
-    in_scope_labels = mm.in_scope_labels
-    used_expr = []  # for avoiding cases wceq.cA wcel.cA
+    f_label_index = get_f_label_index(mm)
+    used_expr = set()  # for avoiding cases wceq.cA wcel.cA
     for i in range(len(leaves)):
         leaf = leaves[i]
         if leaf.type == '$e':
@@ -266,15 +307,15 @@ def standardize(mm, extracted_proof, change_type):
         elif leaf.type == '$f':
             # assert len(leaf.expr) == 2  # not true
             if tuple(leaf.expr) not in replace_dict:
-                for k, v in in_scope_labels.items():  # replace only with main scope variables
-                    if v[0] == '$f' and v[1][0] == leaf.expr[0] and k not in used_mand_vars and k not in ['sub0', 'sub1', 'sub2']:
-                        assert len(v[1]) == 2
+                for k, expr in f_label_index[leaf.expr[0]]:  # replace only with main scope variables
+                    if k not in used_mand_vars:
+                        assert len(expr) == 2
                         # avoid accidentally make theorem constrained
-                        if tuple(v[1]) in used_expr:
+                        if expr in used_expr:
                             continue
                         replace_dict[tuple(leaf.expr)] = k
-                        used_mand_vars.append(k)
-                        used_expr.append(tuple(v[1]))
+                        used_mand_vars.add(k)
+                        used_expr.add(expr)
                         break
                 if tuple(leaf.expr) not in replace_dict:
                     # used up our alphabet
@@ -285,9 +326,14 @@ def standardize(mm, extracted_proof, change_type):
             leaf.data = leaf.expr
         else:
             pass
+    # NOTE this is a fresh walk on purpose: the leaves were just relabeled, so
+    # any summary memoized on the node before standardization would be stale.
+    # summaries of stored, immutable proofs are already cached per label by
+    # MM.get_proof_summary; tree-local summaries are reused by passing them
+    # along (see check_proof_meaningful) rather than cached on ProofNode
     proof_list = extracted_proof.summarize_proof()
     standardized_extracted_proof = mm.propagate_and_substitute_leaf_hps(proof_list, extracted_proof.name)
-    success, _ = mm.verify_custom(standardized_extracted_proof.expr, standardized_extracted_proof.summarize_proof(), '', mode='other')
+    success = verify_cached(mm, standardized_extracted_proof.expr, standardized_extracted_proof.summarize_proof())
     if success:
         print('verified {0}'.format(extracted_proof.name))
         return standardized_extracted_proof
@@ -298,21 +344,23 @@ def standardize(mm, extracted_proof, change_type):
 
 def color_proof_tree(proof, predictions):
     # custom dfs
+    # explicit stack with children pushed in reverse: same pre-order as the
+    # old pop(0) + prepend version without its O(n) shift per visit
     visited = []
     a = [proof]
-    while len(a) > 0:
-        node = a.pop(0)
+    while a:
+        node = a.pop()
         visited.append(node)
-        temp = []
-        for child in node.mand_vars:
-            temp.append(child)
-        for child in node.hps:
-            temp.append(child)
-        a = temp + a
+        for child in reversed(node.hps):
+            a.append(child)
+        for child in reversed(node.mand_vars):
+            a.append(child)
 
     assert len(visited) == len(predictions)
+    # round once while coloring; ProofNode is slotted, so the rounded value
+    # lives in subst itself and the downstream color checks compare it directly
     for i in range(len(visited)):
-        visited[i].subst = predictions[i]
+        visited[i].subst = int(round(float(predictions[i])))
 
 
 def count_proof_name_frequency(mm):
@@ -340,7 +388,9 @@ def analyze_predictions_test(predictions, labels, word_dict, mm, dataset_proof_n
     num_color_all = 0
     num_meaningful = 0  # do not count the correct ones
     counter = 0
-
+    # round the whole label array once; each proof then sums a view instead of
+    # allocating a rounded temp per window
+    rounded_labels = np.round(labels)
     for name in dataset_proof_names:
         if is_expanded:
             variant = int(name.split('_')[-1])
@@ -348,9 +398,10 @@ def analyze_predictions_test(predictions, labels, word_dict, mm, dataset_proof_n
             proof_label = mm_proof_labels[proof_name][variant]
         else:
             proof_label = mm_proof_labels[name]
-        proof_prediction = copy.deepcopy(proof_label)
+        # the deepcopy dominates the per-proof cost and the prediction tree is
+        # only ever drawn here, so it is materialized on demand below
+        proof_prediction = None
         proof_label.name = name + '_label'
-        proof_prediction.name = name + '_prediction'
         proof_raw = export_single_new(proof_label, word_dict, allow_update=False)
         proof_raw.insert(0, name)
 
@@ -358,7 +409,7 @@ def analyze_predictions_test(predictions, labels, word_dict, mm, dataset_proof_n
 
         current_labels = labels[counter:counter + proof_length]
 
-        num_colored_nodes = np.sum(np.round(current_labels))
+        num_colored_nodes = np.sum(rounded_labels[counter:counter + proof_length])
         color_one_or_less = int(num_colored_nodes <= 1)
         if color_one_or_less:
             print(name)
@@ -387,12 +438,17 @@ def analyze_predictions_test(predictions, labels, word_dict, mm, dataset_proof_n
             if meaningful_proof is not None and correct == 0:
                 num_meaningful += 1
                 if save_mode == 'meaningful':
+                    proof_prediction = copy.deepcopy(proof_label)
+                    proof_prediction.name = name + '_prediction'
                     meaningful_proof.draw_graph_2(output_dir=output_directory)
                     proof_prediction.draw_graph_2(output_dir=output_directory)
                     proof_label.draw_graph_2(output_dir=output_directory)
         num_correct += correct
         num_is_tree += is_tree
         if save_mode == 'all':
+            if proof_prediction is None:
+                proof_prediction = copy.deepcopy(proof_label)
+                proof_prediction.name = name + '_prediction'
             proof_prediction.draw_graph_2(output_dir=output_directory)
             proof_label.draw_graph_2(output_dir=output_directory)
         counter += proof_length
@@ -417,6 +473,12 @@ def analyze_predictions(predictions, labels, word_dict, mm, dataset_proof_names,
     num_meaningful = 0  # do not count the correct ones
     counter = 0
     new_theorems = []
+    # round the whole prediction array once and keep it uint8; each proof then
+    # sums a 1-byte view instead of allocating a float temp per window. The
+    # windows cannot be pre-reduced in one reduceat pass because their offsets
+    # only become known as each proof is exported (and skipped proofs do not
+    # advance the counter)
+    rounded_predictions = np.round(predictions).astype(np.uint8)
     for name in dataset_proof_names:
         if is_expanded:
             variant = int(name.split('_')[-1])
@@ -424,9 +486,7 @@ def analyze_predictions(predictions, labels, word_dict, mm, dataset_proof_names,
             proof_label = mm_proof_labels[proof_name][variant]
         else:
             proof_label = mm_proof_labels[name]
-        proof_prediction = copy.deepcopy(proof_label)
         proof_label.name = name + '_label'
-        proof_prediction.name = name + '_prediction'
         proof_raw = export_single_new(proof_label, word_dict, allow_update=False)
         proof_raw.insert(0, name)
 
@@ -438,16 +498,24 @@ def analyze_predictions(predictions, labels, word_dict, mm, dataset_proof_names,
         current_predictions = predictions[counter:counter + proof_length]
         current_labels = labels[counter:counter + proof_length]
 
-        num_colored_nodes = np.sum(np.round(current_predictions))
+        num_colored_nodes = int(np.sum(rounded_predictions[counter:counter + proof_length]))
         color_one_or_less = int(num_colored_nodes <= 1)
         num_color_one_or_less += color_one_or_less
         color_all = int(num_colored_nodes == proof_length)
         num_color_all += color_all
 
-        color_proof_tree(proof_prediction, current_predictions)
         correct = check_proof_correct(current_predictions, current_labels)
         is_tree = check_proof_is_tree(proof_raw, current_predictions)
 
+        # the deepcopy dominates the per-proof cost, so the colored prediction
+        # tree is only built when extraction or drawing will read it
+        if (is_tree == 1 and not color_one_or_less) or save_mode == 'all':
+            proof_prediction = copy.deepcopy(proof_label)
+            proof_prediction.name = name + '_prediction'
+            color_proof_tree(proof_prediction, current_predictions)
+        else:
+            proof_prediction = None
+
         if correct == 1 and is_tree != 1 and not color_one_or_less:
             raise NotImplementedError('if correct, should definitely be a tree')
         # do extraction
@@ -497,13 +565,15 @@ def get_dataset_proof_names(mm_proofs, analyze_data, path):
                 names = pickle.load(f)
         else:
             print('generating proof names')
-            with open(path + '{0}_dataset.pkl'.format(analyze_data), 'rb') as f:
-                dataset_raw = pickle.load(f)
-            names = [e[0] for e in dataset_raw]
-            del dataset_raw
+            names = load_split_proof_names(path, analyze_data)
+            if names is None:
+                # legacy snapshot without a names file: unpickle the split itself
+                dataset_raw = load_split_dataset(path, analyze_data)
+                names = [e[0] for e in dataset_raw]
+                del dataset_raw
             print('done generating proof names')
             with open(path + '{0}_proof_names.pkl'.format(analyze_data), 'wb') as f:
-                pickle.dump(names, f)
+                pickle.dump(names, f, protocol=pickle.HIGHEST_PROTOCOL)
     else:
         names = []
         for k in mm_proofs.keys():
@@ -538,14 +608,21 @@ def remove_redundancy_from_list(proof_list, labels, index):
             if labels[node][0] in ['$f', '$e']:
                 summary[i] = ''
         summary_list.append(tuple(summary))
+    # after masking, every hypothesis label (including the generated sub{N}
+    # ones, which are $f) is '', so similarity degenerates to tuple equality
+    # and a dict of previously seen summaries replaces the pairwise scan;
+    # recording deleted entries too keeps the closest-previous match reported
     delete_list = []
-    for i in range(len(summary_list) - 1, index, -1):
-        assert len(summary_list[i]) > 1
-        for j in range(i - 1, -1, -1):
-            if is_similar(summary_list[i], summary_list[j], True):
-                print('{0} is similar to {1}'.format(proof_list[i].name, proof_list[j].name))
+    seen = {}
+    for i in range(len(summary_list)):
+        current = summary_list[i]
+        if i > index:
+            assert len(current) > 1
+            prev = seen.get(current)
+            if prev is not None:
+                print('{0} is similar to {1}'.format(proof_list[i].name, proof_list[prev].name))
                 delete_list.append(i)
-                break
+        seen[current] = i
     return delete_list
 
 
@@ -558,23 +635,44 @@ def remove_redundancy(mm):
             assert type(v) != list
             original_theorems.append(v)
     delete_list = remove_redundancy_from_list(original_theorems + new_theorems, mm.labels, len(original_theorems) - 1)
-    delete_list = [e - len(original_theorems) for e in delete_list]
-    mm.proofs['new_theorems'] = [new_theorems[i] for i in range(len(new_theorems)) if i not in delete_list]
+    delete_set = {e - len(original_theorems) for e in delete_list}
+    surviving = [i for i in range(len(new_theorems)) if i not in delete_set]
+    mm.proofs['new_theorems'] = [new_theorems[i] for i in surviving]
+    return surviving
+
+
+def load_actual_augmented_mm(save_directory):
+    # the deduplicated database differs from the raw snapshot only in which
+    # new theorems survive, so writing it in full would double the pickle
+    # phase; instead the surviving indices are applied to the raw pickle
+    # here. Runs predating the index file wrote a full actual_augmented_mm.pkl
+    # and still load directly
+    actual_path = save_directory + 'actual_augmented_mm.pkl'
+    if os.path.isfile(actual_path):
+        with open(actual_path, 'rb') as f:
+            return pickle.load(f)
+    with open(save_directory + 'raw_augmented_mm.pkl', 'rb') as f:
+        mm = pickle.load(f)
+    with open(save_directory + 'actual_augmented_mm_indices.pkl', 'rb') as f:
+        surviving = pickle.load(f)
+    new_theorems = mm.proofs['new_theorems']
+    mm.proofs['new_theorems'] = [new_theorems[i] for i in surviving]
+    return mm
 
 
 def get_dvs(proof, labels):
     # custom dfs
+    # explicit stack with children pushed in reverse: same pre-order as the
+    # old pop(0) + prepend version without its O(n) shift per visit
     visited = []
     a = [proof]
-    while len(a) > 0:
-        node = a.pop(0)
+    while a:
+        node = a.pop()
         visited.append(node)
-        temp = []
-        for child in node.mand_vars:
-            temp.append(child)
-        for child in node.hps:
-            temp.append(child)
-        a = temp + a
+        for child in reversed(node.hps):
+            a.append(child)
+        for child in reversed(node.mand_vars):
+            a.append(child)
     all_dvs = []
     for node in visited:
         if node.find_min_height() == 2:
@@ -618,12 +716,14 @@ def get_dvs(proof, labels):
 
 
 def export_single_new_theorem(proof, labels):
-    out = '  ${\n'
+    # accumulate fragments and join once at the end; += on a growing string
+    # recopies it for every dv group and hypothesis
+    parts = ['  ${\n']
     all_dvs = get_dvs(proof, labels)
     for dvs in all_dvs:
         elements = ['$d'] + list(dvs)
         elements.append('$.\n')
-        out += '    ' + ' '.join(elements)
+        parts.append('    ' + ' '.join(elements))
     leaves = proof.get_leaves()
     for leaf in leaves:
         if leaf.type == '$e':
@@ -632,31 +732,32 @@ def export_single_new_theorem(proof, labels):
             elements.append('$e')
             elements += leaf.expr
             elements.append('$.\n')
-            out += '    ' + ' '.join(elements)
+            parts.append('    ' + ' '.join(elements))
     # write proof expression
     res = [proof.name, '$p'] + proof.expr
     res.append('$=')
     for e in proof.summarize_proof():
         res.append(e)
     res.append('$.\n')
-    out += '    ' + ' '.join(res)
-    out += '  $}\n\n'
-    return out
+    parts.append('    ' + ' '.join(res))
+    parts.append('  $}\n\n')
+    return ''.join(parts)
 
 
 def export_new_theorems(file_path, mm):
     if not os.path.isfile(file_path):
         copyfile('set.mm', file_path + 'augmented_set.mm')
-    output = []
     print('before dvs: {0}'.format(len(mm.proofs['new_theorems'])))
-    for proof in mm.proofs['new_theorems']:
-        res = export_single_new_theorem(proof, mm.labels)
-        if res != '':
-            output.append(res)
-    print('after dvs: {0}'.format(len(output)))
-    output = ''.join(output)
-    with open(file_path + 'augmented_set.mm', 'a') as f:
-        f.write(output)
+    num_exported = 0
+    # stream each theorem straight into the appended file instead of joining
+    # one big string first, which held the whole output in memory twice
+    with open(file_path + 'augmented_set.mm', 'a', buffering=1 << 20) as f:
+        for proof in mm.proofs['new_theorems']:
+            res = export_single_new_theorem(proof, mm.labels)
+            if res != '':
+                f.write(res)
+                num_exported += 1
+    print('after dvs: {0}'.format(num_exported))
 
 
 def main(args):
@@ -732,24 +833,34 @@ def main(args):
                 loader = get_data(loader_path, analyze_data, word_dict, max_length, batch_size, direction, use_node_information, num_workers=0, shuffle=False, partial=1.0, num_nodes_limit_per_batch=num_nodes_limit_per_batch)
             predictions, labels = evaluate_loader(loader, model, gpu)
             del loader
-            np.save(save_directory + '{0}_prediction.npy'.format(analyze_data), predictions)
-            np.save(save_directory + '{0}_label.npy'.format(analyze_data), labels)
+            # float32 keeps the sigmoid outputs and 0/1 labels exactly while
+            # halving the file size over numpy's float64 default
+            predictions = np.asarray(predictions, dtype=np.float32)
+            labels = np.asarray(labels, dtype=np.float32)
+            np.save(save_directory + '{0}_prediction.npy'.format(analyze_data), predictions, allow_pickle=False)
+            np.save(save_directory + '{0}_label.npy'.format(analyze_data), labels, allow_pickle=False)
         else:
             print('loading predictions and labels for {0}'.format(analyze_data))
-            predictions = np.load(save_directory + '{0}_prediction.npy'.format(analyze_data))
-            labels = np.load(save_directory + '{0}_label.npy'.format(analyze_data))
+            # read-only memory map: the analysis slices per-proof windows, so
+            # pages fault in on demand instead of loading the arrays up front
+            predictions = np.load(save_directory + '{0}_prediction.npy'.format(analyze_data), mmap_mode='r')
+            labels = np.load(save_directory + '{0}_label.npy'.format(analyze_data), mmap_mode='r')
 
         # count_proof_name_frequency(mm)
         dataset_proof_names = get_dataset_proof_names(mm.proofs, analyze_data, loader_path)
         analyze_predictions(predictions, labels, word_dict, mm, dataset_proof_names, analyze_data != 'unexpanded', figure_save_directory, save_mode)
         # test for labels
     print('total raw new theorems is {0}'.format(len(mm.proofs['new_theorems'])))
-    with open(save_directory + 'raw_augmented_mm.pkl', 'wb') as f:
-        pickle.dump(mm, f)
-    remove_redundancy(mm)
+    # large dumps: highest protocol for framing/size, 1 MiB buffer to
+    # amortize write syscalls, as in the refactor export
+    with open(save_directory + 'raw_augmented_mm.pkl', 'wb', buffering=1 << 20) as f:
+        pickle.dump(mm, f, protocol=pickle.HIGHEST_PROTOCOL)
+    surviving = remove_redundancy(mm)
     print('total actual new theorems is {0}'.format(len(mm.proofs['new_theorems'])))
-    with open(save_directory + 'actual_augmented_mm.pkl', 'wb') as f:
-        pickle.dump(mm, f)
+    # the raw snapshot plus the surviving indices fully determine the
+    # deduplicated database, see load_actual_augmented_mm
+    with open(save_directory + 'actual_augmented_mm_indices.pkl', 'wb') as f:
+        pickle.dump(surviving, f, protocol=pickle.HIGHEST_PROTOCOL)
 
     export_new_theorems(save_directory, mm)
 
@@ -4,14 +4,66 @@ from model_names import model_names_dict
 from data import get_data
 import argparse
 import os
+import re
 import json
+try:
+    # serializes numpy-typed args natively and faster than stdlib json
+    import orjson
+except ImportError:
+    orjson = None
 import numpy as np
-import git
 import random
 import torch
 from utils import CustomCheckpoint
 
 
+def get_git_hash():
+    # read HEAD straight from the .git directory: importing gitpython and its
+    # subprocesses costs a noticeable slice of startup for every launched job,
+    # and only the commit hash is needed
+    repo_dir = os.path.abspath(os.path.dirname(__file__))
+    while not os.path.exists(os.path.join(repo_dir, '.git')):
+        parent = os.path.dirname(repo_dir)
+        if parent == repo_dir:
+            raise RuntimeError('not inside a git repository')
+        repo_dir = parent
+    git_dir = os.path.join(repo_dir, '.git')
+    if os.path.isfile(git_dir):
+        # worktree or submodule checkout: .git is a file pointing at the real
+        # git directory
+        with open(git_dir) as f:
+            gitdir_line = f.read().strip()
+        if not gitdir_line.startswith('gitdir:'):
+            raise RuntimeError('malformed .git file at {0}'.format(git_dir))
+        git_dir = gitdir_line.split(':', 1)[1].strip()
+        if not os.path.isabs(git_dir):
+            git_dir = os.path.normpath(os.path.join(repo_dir, git_dir))
+    # worktree git dirs keep their own HEAD but share refs and packed-refs
+    # through the directory named in commondir
+    common_path = os.path.join(git_dir, 'commondir')
+    if os.path.isfile(common_path):
+        with open(common_path) as f:
+            common_dir = os.path.normpath(os.path.join(git_dir, f.read().strip()))
+    else:
+        common_dir = git_dir
+    with open(os.path.join(git_dir, 'HEAD')) as f:
+        head = f.read().strip()
+    if not head.startswith('ref:'):
+        return head  # detached HEAD stores the hash directly
+    ref = head.split(' ', 1)[1]
+    ref_path = os.path.join(common_dir, ref)
+    if os.path.isfile(ref_path):
+        with open(ref_path) as f:
+            return f.read().strip()
+    # ref not checked out loose, resolve it from packed-refs; match the full
+    # ref after the hash so one ref cannot match another ref's suffix
+    with open(os.path.join(common_dir, 'packed-refs')) as f:
+        for line in f:
+            if not line.startswith('#') and line.rstrip().endswith(' ' + ref):
+                return line.split(' ', 1)[0]
+    raise RuntimeError('cannot resolve git ref {0}'.format(ref))
+
+
 def main(args):
     data_path = args.data_path
     validation_path = args.validation_path
@@ -25,6 +77,15 @@ def main(args):
     direction = args.direction
     use_node_information = args.use_node_information
     num_workers = args.num_workers
+    if num_workers < 0:
+        # -1 means auto: on GPU runs size the loader pool from the machine so
+        # loading overlaps compute; explicit counts, including 0 for
+        # single-process debugging, are used as given
+        if gpus > 0:
+            num_workers = min(8, max(1, (os.cpu_count() or 2) // 2))
+            print('num_workers auto-set to {0}'.format(num_workers))
+        else:
+            num_workers = 0
     period = args.period
     partial_dataset = args.partial_dataset
     num_nodes_limit_per_batch = args.num_nodes_limit_per_batch
@@ -35,12 +96,19 @@ def main(args):
     valid_loader = get_data(validation_path, 'valid', word_dict, max_length, batch_size, direction, use_node_information, num_workers=num_workers, shuffle=False, partial=1, num_nodes_limit_per_batch=num_nodes_limit_per_batch)
     arg_dict['num_words'] = len(word_dict)
     model = model_names_dict[model](**arg_dict)
-    all_checkpoints = [f for f in os.listdir(checkpoint_directory) if os.path.isfile(checkpoint_directory + f) and 'epoch' in f]
+    # scandir reuses the directory entries' cached stat info, so no extra
+    # isfile syscall per entry; the regex also skips temp.ckpt and other
+    # non-checkpoint files that happen to contain 'epoch'
+    checkpoint_pattern = re.compile(r'epoch=(\d+)\.ckpt')
+    all_checkpoints = []
+    with os.scandir(checkpoint_directory) as it:
+        for entry in it:
+            match = checkpoint_pattern.fullmatch(entry.name)
+            if match is not None and entry.is_file():
+                all_checkpoints.append((int(match.group(1)), entry.name))
     if len(all_checkpoints) > 0:
-        print(all_checkpoints)
-        checkpoint_epochs = [int(e.replace('epoch=', '').replace('.ckpt', '')) for e in all_checkpoints]
-        last_checkpoint_index = checkpoint_epochs.index(max(checkpoint_epochs))
-        last_checkpoint = all_checkpoints[last_checkpoint_index]
+        print([name for _, name in all_checkpoints])
+        last_checkpoint = max(all_checkpoints)[1]
         print('resuming checkpoint: {0}'.format(last_checkpoint))
         checkpoint_callback = CustomCheckpoint(checkpoint_directory=checkpoint_directory, save_directory=save_path, period=period)
         trainer = pl.Trainer(resume_from_checkpoint=checkpoint_directory + last_checkpoint, max_epochs=num_epochs, gpus=gpus, default_root_dir=save_path, checkpoint_callback=checkpoint_callback, num_sanity_val_steps=0)
@@ -60,7 +128,7 @@ if __name__ == '__main__':
     parser.add_argument('-checkpoint', dest='checkpoint_directory', type=str, default='checkpoints/')  # refers to checkpoint directory
     parser.add_argument('-name', dest='experiment_name', type=str, default='experiment0')  # experiment name
     parser.add_argument('-g', dest='gpus', type=int, default=1)
-    parser.add_argument('-num_workers', dest='num_workers', type=int, default=0)
+    parser.add_argument('-num_workers', dest='num_workers', type=int, default=-1)  # -1: auto-size on GPU runs
     parser.add_argument('-seed', dest='seed', type=int, default=47)
     parser.add_argument('-period', dest='period', type=int, default=1)
     # data
@@ -99,8 +167,7 @@ if __name__ == '__main__':
     torch.backends.cudnn.deterministic = True
     torch.backends.cudnn.benchmark = False
 
-    repo = git.Repo(search_parent_directories=True)
-    sha = repo.head.object.hexsha
+    sha = get_git_hash()
     arg_dict = vars(args)
     arg_dict['git_hash'] = sha
     print(arg_dict)
@@ -110,7 +177,11 @@ if __name__ == '__main__':
         os.makedirs(args.save_directory)
     if not os.path.isdir(args.checkpoint_directory):
         os.makedirs(args.checkpoint_directory)
-    with open(args.save_directory + 'args.json', 'w') as fp:
-        json.dump(arg_dict, fp)
+    if orjson is not None:
+        with open(args.save_directory + 'args.json', 'wb') as fp:
+            fp.write(orjson.dumps(arg_dict, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
+    else:
+        with open(args.save_directory + 'args.json', 'w') as fp:
+            json.dump(arg_dict, fp)
     main(args)
     print('done')
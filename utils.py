@@ -1,9 +1,11 @@
 import os
+import logging
+import tempfile
 import pytorch_lightning as pl
 import pickle
-from collections import Counter
 import numpy as np
-import copy
+
+logger = logging.getLogger(__name__)
 
 
 class CustomCheckpoint(pl.callbacks.ModelCheckpoint):
@@ -15,115 +17,134 @@ class CustomCheckpoint(pl.callbacks.ModelCheckpoint):
         self.save_directory = save_directory  # used for last save
 
     def save_checkpoint_atomic(self, trainer, save_path):
-        temp_path = os.path.join(os.path.dirname(save_path), "temp.ckpt")
+        # NOTE checkpoints stay plain torch.save output: resume goes through
+        # Trainer(resume_from_checkpoint=...), whose internal torch.load would
+        # not see through an external zstd stream, and torch's zipfile format
+        # (default since 1.6) already deduplicates shared storages
+        if not trainer.is_global_zero:
+            # save_checkpoint only writes on global rank 0; without this guard
+            # the other ranks would replace the checkpoint with their empty
+            # temp file
+            return
+        final_path = save_path + 'epoch={0}.ckpt'.format(trainer.current_epoch)
+        # the temp file lives next to the final name, so os.replace stays an
+        # atomic same-filesystem rename even when save paths point at another
+        # mount; mkstemp also keeps concurrent runs from clobbering each other
+        fd, temp_path = tempfile.mkstemp(suffix='.ckpt.tmp', dir=os.path.dirname(final_path))
+        os.close(fd)
         trainer.save_checkpoint(temp_path)
-        os.replace(temp_path, save_path + 'epoch={0}.ckpt'.format(trainer.current_epoch))
-        if os.path.isfile(save_path + 'epoch={0}.ckpt'.format(trainer.current_epoch - self.period)):
+        os.replace(temp_path, final_path)
+        try:
             os.remove(save_path + 'epoch={0}.ckpt'.format(trainer.current_epoch - self.period))
+        except FileNotFoundError:
+            pass
 
     def on_validation_end(self, trainer, pl_module):
         """
         checkpoints can be saved at the end of the val loop
         """
         if (trainer.current_epoch + 1) % self.period == 0:
-            print('saving checkpoint at epoch {0}'.format(trainer.current_epoch))
+            # only rank 0 logs, so multi-GPU runs do not serialize on stdout
+            # every validation epoch; save_checkpoint_atomic returns early on
+            # the other ranks
+            if trainer.is_global_zero:
+                logger.info('saving checkpoint at epoch %d', trainer.current_epoch)
             self.save_checkpoint_atomic(trainer, self.checkpoint_directory)
 
 
 def subtract_datasets(d_1, d_2):
-    # d_1 - d_2
-    names_2 = [e[0] for e in d_2]
-    res = []
-    for i in range(len(d_1)):
-        e = d_1[i]
-        if e[0] not in names_2:
-            res.append(e)
-    return res
+    # d_1 - d_2; membership goes through a name set, not a list scan.
+    # NOTE a sorted numpy array + searchsorted was considered instead of the
+    # set: it loses here because np.array copies every name into fixed-width
+    # UCS-4 storage and each lookup pays O(log m) string compares, while str
+    # objects cache their hash so the set probe compares at most once
+    names_2 = {e[0] for e in d_2}
+    return [e for e in d_1 if e[0] not in names_2]
 
 
 def union_datasets(d_1, d_2):
-    names_1 = [e[0] for e in d_1]
-    names_2 = [e[0] for e in d_2]
-    if len(names_1) > len(names_2):
-        res = copy.deepcopy(d_1)
-        for i in range(len(d_2)):
-            e = d_2[i]
-            if e[0] not in names_1:
-                res.append(e)
+    # entries are only appended, never mutated, so a shallow copy of the
+    # larger side replaces the old deepcopy; the result aliases both inputs,
+    # callers that want to mutate entries must copy them first
+    names_1 = {e[0] for e in d_1}
+    names_2 = {e[0] for e in d_2}
+    if len(d_1) > len(d_2):
+        res = list(d_1)
+        res.extend(e for e in d_2 if e[0] not in names_1)
     else:
-        res = copy.deepcopy(d_2)
-        for i in range(len(d_1)):
-            e = d_1[i]
-            if e[0] not in names_2:
-                res.append(e)
+        res = list(d_2)
+        res.extend(e for e in d_1 if e[0] not in names_2)
     return res
 
 
 def merge_datasets(dataset_path_1, dataset_path_2):
-    with open(dataset_path_1 + 'train_dataset.pkl', 'rb') as f:
-        train_dataset_1 = pickle.load(f)
-    with open(dataset_path_1 + 'valid_dataset.pkl', 'rb') as f:
-        valid_dataset_1 = pickle.load(f)
-    with open(dataset_path_2 + 'train_dataset.pkl', 'rb') as f:
-        train_dataset_2 = pickle.load(f)
-    with open(dataset_path_2 + 'valid_dataset.pkl', 'rb') as f:
-        valid_dataset_2 = pickle.load(f)
-    difference_1 = subtract_datasets(valid_dataset_1, train_dataset_2)
-    difference_2 = subtract_datasets(valid_dataset_2, train_dataset_1)
-    res = union_datasets(difference_1, difference_2)
+    # imported here so the training entry point does not inherit the
+    # data-preparation dependencies
+    from theorem_expansion import load_split_dataset
+    train_dataset_1 = load_split_dataset(dataset_path_1, 'train')
+    valid_dataset_1 = load_split_dataset(dataset_path_1, 'valid')
+    train_dataset_2 = load_split_dataset(dataset_path_2, 'train')
+    valid_dataset_2 = load_split_dataset(dataset_path_2, 'valid')
+    # fused (valid_1 - train_2) | (valid_2 - train_1): each name set is built
+    # once and the union is keyed by name in the same pass, so no intermediate
+    # difference lists; on a shared name the first valid set's entry wins
+    train_names_1 = {e[0] for e in train_dataset_1}
+    train_names_2 = {e[0] for e in train_dataset_2}
+    res = [e for e in valid_dataset_1 if e[0] not in train_names_2]
+    seen = {e[0] for e in res}
+    res.extend(e for e in valid_dataset_2 if e[0] not in train_names_1 and e[0] not in seen)
     return res
 
 
 def merge_datasets_2(dataset_path_1, dataset_path_2, output_path):
-    with open(dataset_path_1 + 'valid_dataset.pkl', 'rb') as f:
-        valid_dataset_1 = pickle.load(f)
-    with open(dataset_path_1 + 'test_dataset.pkl', 'rb') as f:
-        test_dataset_1 = pickle.load(f)
-    with open(dataset_path_2 + 'train_dataset.pkl', 'rb') as f:
-        train_dataset_2 = pickle.load(f)
-    difference_1 = subtract_datasets(valid_dataset_1, train_dataset_2)
-    difference_2 = subtract_datasets(test_dataset_1, train_dataset_2)
-    res = union_datasets(difference_1, difference_2)
-
-    theorem_names = []
-    for e in res:
-        name = e[0]
-        expanding_theorem = name[name.find('expand_') + 7:name.find('_in_')]
-        theorem_names.append(expanding_theorem)
-    counts = list(Counter(theorem_names).values())
+    from theorem_expansion import load_split_dataset
+    valid_dataset_1 = load_split_dataset(dataset_path_1, 'valid')
+    test_dataset_1 = load_split_dataset(dataset_path_1, 'test')
+    train_dataset_2 = load_split_dataset(dataset_path_2, 'train')
+    # same fused pass as merge_datasets, with both differences against the
+    # one training set; valid entries win over test entries on a shared name
+    train_names_2 = {e[0] for e in train_dataset_2}
+    res = [e for e in valid_dataset_1 if e[0] not in train_names_2]
+    seen = {e[0] for e in res}
+    res.extend(e for e in test_dataset_1 if e[0] not in train_names_2 and e[0] not in seen)
+
+    # one split per name instead of two find scans plus a slice; only the
+    # counts are saved, so np.unique's per-theorem counts replace the Counter
+    # (sorted by theorem name rather than first-seen order)
+    theorem_names = [e[0].split('expand_', 1)[1].split('_in_', 1)[0] for e in res]
+    _, counts = np.unique(np.asarray(theorem_names), return_counts=True)
     with open(output_path + 'valid_dataset.pkl', 'wb') as f:
-        pickle.dump(res, f)
+        pickle.dump(res, f, protocol=pickle.HIGHEST_PROTOCOL)
     np.save(output_path + 'expanding_theorem_histogram_valid.npy', counts)
 
 
 def filter_nodes_to_tokens(load_path, output_path, token_length):
-    with open(load_path + 'train.src', 'r') as f:
-        train_source = f.readlines()
-    with open(load_path + 'train.tgt', 'r') as f:
-        train_target = f.readlines()
     with open(load_path + 'train_proof_names.pkl', 'rb') as f:
         train_proof_names = pickle.load(f)
-    assert len(train_source) == len(train_target)
-    assert len(train_target) == len(train_proof_names)
-    delete_indices = []
-    for i in range(len(train_source)):
-        source = train_source[i]
-        if len(source.split()) > token_length:
-            delete_indices.append(i)
-
-    for i in range(len(train_target)):
-        target = train_target[i]
-        if len(target.split()) > token_length:
-            delete_indices.append(i)
-    delete_indices = list(set(delete_indices))
-    for i in range(len(train_source) - 1, -1, -1):
-        if i in delete_indices:
-            del train_source[i]
-            del train_target[i]
-            del train_proof_names[i]
-    with open(output_path + 'train.src', 'w') as f:
-        f.writelines(train_source)
-    with open(output_path + 'train.tgt', 'w') as f:
-        f.writelines(train_target)
+    # the corpus files are streamed line by line and kept lines written
+    # straight through 1 MiB buffers, so peak memory stays at the names list
+    # instead of two full copies of the corpus and there is no delete pass
+    # over in-memory lists at all. Token counting is str.count(' ') + 1 --
+    # equal to the old len(split()) because the exported lines are
+    # single-space separated with no leading or trailing blanks, and no split
+    # list is allocated per line -- and stays single-process:
+    # it runs at C speed near memory bandwidth, so
+    # fanning lines out to worker processes would spend more time pickling
+    # the corpus across the pool than counting it
+    kept_names = []
+    num_lines = 0
+    with open(load_path + 'train.src', 'r') as f_src, \
+            open(load_path + 'train.tgt', 'r') as f_tgt, \
+            open(output_path + 'train.src', 'w', buffering=1 << 20) as out_src, \
+            open(output_path + 'train.tgt', 'w', buffering=1 << 20) as out_tgt:
+        for source, target, name in zip(f_src, f_tgt, train_proof_names):
+            num_lines += 1
+            if source.count(' ') + 1 <= token_length and target.count(' ') + 1 <= token_length:
+                out_src.write(source)
+                out_tgt.write(target)
+                kept_names.append(name)
+        # zip stops at the shortest input, so recheck the three really were parallel
+        assert f_src.readline() == '' and f_tgt.readline() == ''
+        assert num_lines == len(train_proof_names)
     with open(output_path + 'train_proof_names.pkl', 'wb') as f:
-        pickle.dump(train_proof_names, f)
+        pickle.dump(kept_names, f, protocol=pickle.HIGHEST_PROTOCOL)